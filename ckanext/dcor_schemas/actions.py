@@ -1,9 +1,11 @@
+import re
 import uuid
 
 import ckan.plugins.toolkit as toolkit
 
 from dcor_shared import get_ckan_config_option, s3
 
+from . import checksum
 from . import resource_schema_supplements as rss
 from .validate import RESOURCE_EXTS
 
@@ -19,7 +21,13 @@ def get_resource_upload_s3_urls(context, data_dict):
     data_dict: dict
         Dictionary containing the key ID "organization_id", the
         organization ID containing the dataset to which the
-        resource will belong.
+        resource will belong. The optional key "sha256" may contain
+        the SHA256 sum (hex digest) of the file. For files that are
+        uploaded with a single PUT request (1 GiB or less), S3 then
+        verifies the checksum during the upload and the SHA256 sum
+        does not have to be computed in a background job. The
+        headers in "upload_headers" of the returned dictionary must
+        be sent with the upload request.
 
     Once the file is uploaded, it is private by default. Setting the
     `public=true` tag to a resource will make it public. This is taken
@@ -29,6 +37,12 @@ def get_resource_upload_s3_urls(context, data_dict):
     # is a member of the organization.
     org_id = data_dict["organization_id"]
     file_size = int(float(data_dict["file_size"]))
+    sha256 = data_dict.get("sha256")
+    if sha256 is not None:
+        sha256 = str(sha256).lower()
+        if not re.fullmatch(r"[0-9a-f]{64}", sha256):
+            raise toolkit.ValidationError(
+                {"sha256": ["Invalid SHA256 hex digest"]})
     bucket_name = get_ckan_config_option(
         "dcor_object_store.bucket_name").format(
         organization_id=org_id)
@@ -43,14 +57,27 @@ def get_resource_upload_s3_urls(context, data_dict):
     else:
         raise KeyError("Could not allocate a free UUID for a new resource")
     object_name = f"resource/{rid[:3]}/{rid[3:6]}/{rid[6:]}"
-    upload_urls, complete_url = s3.create_presigned_upload_urls(
-        bucket_name=bucket_name,
-        object_name=object_name,
-        file_size=file_size,
-        # the default expiration time is 1 day
-    )
+    upload_headers = {}
+    if sha256 is not None and file_size <= checksum.SINGLE_PART_MAX_SIZE:
+        # S3 can only verify full-object SHA256 sums for single uploads
+        upload_url, upload_headers = \
+            checksum.create_presigned_upload_url_with_checksum(
+                bucket_name=bucket_name,
+                object_name=object_name,
+                sha256=sha256,
+            )
+        upload_urls = [upload_url]
+        complete_url = None
+    else:
+        upload_urls, complete_url = s3.create_presigned_upload_urls(
+            bucket_name=bucket_name,
+            object_name=object_name,
+            file_size=file_size,
+            # the default expiration time is 1 day
+        )
     data = {
         "upload_urls": upload_urls,
+        "upload_headers": upload_headers,
         "complete_url": complete_url,
         "resource_id": rid,
     }
@@ -1,4 +1,5 @@
 from email.utils import parseaddr
+import functools
 import re
 
 from ckan.common import asbool, config
@@ -10,6 +11,19 @@ from . import helpers as dcor_helpers
 from . import resource_schema_supplements as rss
 
 
+#: Resource metadata keys (in addition to :func:`resource_editable_metadata`)
+#: that may be specified when creating a resource uploaded to S3
+RESOURCE_CREATE_S3_KEYS = frozenset(
+    ["id", "name", "package_id", "s3_available"])
+
+#: Resource metadata keys (in addition to :func:`resource_editable_metadata`)
+#: that may be specified for legacy uploads (some of these are set by the
+#: uploader class)
+RESOURCE_CREATE_LEGACY_KEYS = frozenset(
+    ["name", "package_id", "upload", "url", "url_type",
+     "last_modified", "mimetype", "size"])
+
+
 @logic.auth_allow_anonymous_access
 def content_listing(context, data_dict):
     """manage access for listing all circles, groups, tags"""
@@ -30,15 +44,8 @@ def dataset_purge(context, data_dict):
         return aut
 
     # get the current package dict
-    show_context = {
-        'model': context['model'],
-        'session': context['session'],
-        'user': context['user'],
-        'auth_user_obj': context['auth_user_obj'],
-    }
-    pkg_dict = logic.get_action('package_show')(
-        show_context,
-        {'id': get_package_id(context, data_dict)})
+    pkg_dict = dcor_helpers.get_package_dict(
+        context, get_package_id(context, data_dict))
     state = pkg_dict.get('state')
     if state != "deleted":
         return {"success": False,
@@ -146,15 +153,8 @@ def package_delete(context, data_dict):
         return aut
 
     # get the current package dict
-    show_context = {
-        'model': context['model'],
-        'session': context['session'],
-        'user': context['user'],
-        'auth_user_obj': context['auth_user_obj'],
-    }
-    pkg_dict = logic.get_action('package_show')(
-        show_context,
-        {'id': get_package_id(context, data_dict)})
+    pkg_dict = dcor_helpers.get_package_dict(
+        context, get_package_id(context, data_dict))
     state = pkg_dict.get('state')
     if state != "draft":
         return {"success": False,
@@ -172,15 +172,8 @@ def package_update(context, data_dict=None):
         data_dict = {}
 
     # get the current package dict
-    show_context = {
-        'model': context['model'],
-        'session': context['session'],
-        'user': context['user'],
-        'auth_user_obj': context['auth_user_obj'],
-    }
-    ds_dict = logic.get_action('package_show')(
-        show_context,
-        {'id': get_package_id(context, data_dict)})
+    ds_dict = dcor_helpers.get_package_dict(
+        context, get_package_id(context, data_dict))
     resources_exist = ds_dict["resources"]
 
     # run resource check functions
@@ -205,7 +198,8 @@ def package_update(context, data_dict=None):
         # during upload, unless the resource was already uploaded to S3.
         new_res["package_id"] = ds_dict["id"]
         # only admin users are allowed to set these values (extra security)
-        for key in ["sha256", "etag"]:
+        for key in ["sha256", "etag",
+                    "dc_sanity_passed", "dc_sanity_etag"]:
             if key in new_res:
                 if cur_res is None:
                     return {"success": False,
@@ -323,21 +317,20 @@ def resource_create_check(context, new_dict, ds_dict=None):
         return aut
 
     if ds_dict is None:
-        ds_dict = logic.get_action('package_show')(
-            dict(context, return_type='dict'),
-            {'id': new_dict["package_id"]})
+        ds_dict = dcor_helpers.get_package_dict(context,
+                                                new_dict["package_id"])
 
     # resource id must not be set, unless the corresponding
     # S3 object exists
     rid = new_dict.get("id")
     if rid:
         # We want to ignore keys in the dictionary that did not change.
-        unchanged_keys = []
+        unchanged_keys = set()
         for res_dict_old in ds_dict["resources"]:
             if res_dict_old["id"] == rid:
                 for key in new_dict:
                     if res_dict_old.get(key) == new_dict[key]:
-                        unchanged_keys.append(key)
+                        unchanged_keys.add(key)
                 break
 
         # Double-check that the resource does not already exist
@@ -356,11 +349,15 @@ def resource_create_check(context, new_dict, ds_dict=None):
                     'msg': f'Resource {rid} not available on S3!'}
         # Also make sure that the user did not specify more metadata
         # than allowed.
-        allowed_keys = resource_editable_metadata().union(
-            {"id", "name", "package_id", "s3_available"}).union(
-                set(unchanged_keys))
-        if not set(new_dict.keys()).issubset(allowed_keys):
-            changed_keys = [k for k in new_dict if k not in allowed_keys]
+        editable_keys = resource_editable_metadata()
+        changed_keys = [k for k in new_dict
+                        if k not in editable_keys
+                        and k not in RESOURCE_CREATE_S3_KEYS
+                        and k not in unchanged_keys]
+        if changed_keys:
+            allowed_keys = (editable_keys
+                            | RESOURCE_CREATE_S3_KEYS
+                            | unchanged_keys)
             return {'success': False,
                     'msg': f'For resource uploads via S3, you may only '
                            f'change the metadata keys {sorted(allowed_keys)}. '
@@ -371,11 +368,11 @@ def resource_create_check(context, new_dict, ds_dict=None):
                     'msg': '"s3_available" must be set to True'}
     else:
         # Legacy upload
-        allowed_keys = resource_editable_metadata().union(
-            # some of these are set by the uploader class
-            {"name", "package_id", "upload", "url", "url_type",
-             "last_modified", "mimetype", "size"})
-        if not set(new_dict.keys()).issubset(allowed_keys):
+        editable_keys = resource_editable_metadata()
+        if [k for k in new_dict
+                if k not in editable_keys
+                and k not in RESOURCE_CREATE_LEGACY_KEYS]:
+            allowed_keys = editable_keys | RESOURCE_CREATE_LEGACY_KEYS
             return {'success': False,
                     'msg': f'For legacy resource uploads, you may only '
                            f'specify the metadata {sorted(allowed_keys)}. "'
@@ -386,18 +383,26 @@ def resource_create_check(context, new_dict, ds_dict=None):
 
 
 def resource_editable_metadata():
-    """Set of resource metadata keys that may be edited for draft datasets"""
+    """Set of resource metadata keys that may be edited for draft datasets
+
+    The returned set is immutable and computed only once for each
+    supplementary resource schema.
+    """
+    return _get_resource_editable_metadata(rss.get_supplement_index())
+
+
+@functools.lru_cache(maxsize=32)
+def _get_resource_editable_metadata(supplement_index):
     # "sp:*" keys and "description"
-    return set(rss.get_composite_item_list() + ["description"])
+    return supplement_index.composite_key_set | {"description"}
 
 
 def resource_auth_general(context, new_dict, ds_dict=None):
     """General checks for adding or changing resource data"""
     if "package_id" in new_dict:
         if ds_dict is None:
-            ds_dict = logic.get_action('package_show')(
-                dict(context, return_type='dict'),
-                {'id': new_dict["package_id"]})
+            ds_dict = dcor_helpers.get_package_dict(context,
+                                                    new_dict["package_id"])
 
             # do not allow adding resources to non-draft datasets
             if ds_dict["state"] != "draft":
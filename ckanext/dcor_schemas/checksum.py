@@ -0,0 +1,154 @@
+import base64
+import binascii
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import time
+
+from dcor_shared import s3
+
+from . import s3_meta
+
+
+logger = logging.getLogger(__name__)
+
+#: Size of the byte ranges downloaded from S3 in one request
+CHUNK_SIZE = 8 * 2 ** 20
+#: Number of threads downloading byte ranges concurrently
+NUM_THREADS = 4
+#: Number of chunks kept in memory (downloaded, but not hashed yet)
+NUM_BUFFERS = 2 * NUM_THREADS
+#: Number of attempts for downloading a byte range
+NUM_RETRIES = 5
+#: Maximum size of objects uploaded with a single PUT request (see
+#: :func:`dcor_shared.s3.create_presigned_upload_urls`)
+SINGLE_PART_MAX_SIZE = 1024**3
+
+
+def compute_checksum(bucket_name, object_name, size=None,
+                     chunk_size=CHUNK_SIZE, num_threads=NUM_THREADS,
+                     num_buffers=NUM_BUFFERS, progress_callback=None):
+    """Compute the SHA256 checksum of an S3 object with parallel downloads
+
+    The object is downloaded in ranged GET requests by `num_threads`
+    threads. At most `num_buffers` chunks are held in memory and the
+    chunks are hashed in order as soon as they are available.
+
+    Parameters
+    ----------
+    bucket_name: str
+        name of the bucket
+    object_name: str
+        object key
+    size: int
+        size of the object in bytes (determined via S3 if not given)
+    chunk_size: int
+        size of the byte ranges downloaded in one request
+    num_threads: int
+        number of download threads
+    num_buffers: int
+        maximum number of chunks held in memory
+    progress_callback: callable
+        called with the number of hashed bytes and the total number
+        of bytes after each chunk
+    """
+    s3_client, _, _ = s3.get_s3()
+    if size is None:
+        meta = s3_client.head_object(Bucket=bucket_name, Key=object_name)
+        size = meta["ContentLength"]
+    num_buffers = max(num_buffers, num_threads)
+
+    def download_range(start):
+        stop = min(start + chunk_size, size) - 1  # range is inclusive
+        for ii in range(NUM_RETRIES):
+            try:
+                resp = s3_client.get_object(Bucket=bucket_name,
+                                            Key=object_name,
+                                            Range=f"bytes={start}-{stop}")
+                data = resp["Body"].read()
+                if len(data) != stop - start + 1:
+                    raise IOError(f"Incomplete read for bytes {start}-{stop} "
+                                  f"of {bucket_name}:{object_name}")
+                return data
+            except Exception:
+                if ii == NUM_RETRIES - 1:
+                    raise
+                logger.warning(f"Retrying download of bytes {start}-{stop} "
+                               f"of {bucket_name}:{object_name}")
+                time.sleep(2 ** ii)
+
+    hasher = hashlib.sha256()
+    offsets = iter(range(0, size, chunk_size))
+    pending = deque()
+    hashed = 0
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for start in offsets:
+            pending.append(pool.submit(download_range, start))
+            if len(pending) == num_buffers:
+                break
+        while pending:
+            data = pending.popleft().result()
+            # refill the ring of buffers before hashing
+            for start in offsets:
+                pending.append(pool.submit(download_range, start))
+                break
+            hasher.update(data)
+            hashed += len(data)
+            if progress_callback is not None:
+                progress_callback(hashed, size)
+    return hasher.hexdigest()
+
+
+def create_presigned_upload_url_with_checksum(bucket_name, object_name,
+                                              sha256, expiration=86400):
+    """Create a presigned PUT URL for which S3 verifies the SHA256 sum
+
+    The returned URL is only valid if the client sends the returned
+    headers with the upload. S3 then rejects the upload if the
+    SHA256 sum of the uploaded data does not match `sha256` and
+    stores it as the full-object checksum of the object (see
+    :func:`get_verified_checksum`). This only works for uploads with
+    a single PUT request (see :const:`SINGLE_PART_MAX_SIZE`).
+
+    Returns
+    -------
+    upload_url: str
+        presigned URL for uploading the object
+    upload_headers: dict
+        headers that must be sent with the upload request
+    """
+    s3.require_bucket(bucket_name)
+    s3_client, _, _ = s3.get_s3()
+    checksum_b64 = base64.b64encode(bytes.fromhex(sha256)).decode()
+    upload_url = s3_client.generate_presigned_url(
+        "put_object",
+        Params={"Bucket": bucket_name,
+                "Key": object_name,
+                "ChecksumSHA256": checksum_b64,
+                },
+        ExpiresIn=expiration,
+        HttpMethod="PUT",
+    )
+    return upload_url, {"x-amz-checksum-sha256": checksum_b64}
+
+
+def get_verified_checksum(bucket_name, object_name):
+    """Return the SHA256 sum of an S3 object verified by S3 during upload
+
+    Returns None if S3 does not have a full-object SHA256 checksum for
+    the object. This is the case for objects that were uploaded without
+    checksum and for multipart uploads, for which S3 only stores a
+    checksum of the part checksums.
+    """
+    meta = s3_meta.get_object_meta(bucket_name, object_name)
+    checksum_b64 = meta["checksum_sha256"]
+    if (not checksum_b64
+            or "-" in checksum_b64
+            or (meta["checksum_type"] or "FULL_OBJECT") != "FULL_OBJECT"):
+        return None
+    try:
+        sha256 = base64.b64decode(checksum_b64, validate=True).hex()
+    except (binascii.Error, ValueError):
+        return None
+    return sha256 if len(sha256) == 64 else None
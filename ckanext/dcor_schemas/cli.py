@@ -1,51 +1,408 @@
+import csv
 import datetime
+import json
+import multiprocessing
 import pathlib
 import sys
 import time
 import traceback
 
-from ckan import logic
+from ckan import authz, logic
 from ckan.lib import mailer
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 import click
-from dcor_shared import s3, s3cc, get_ckan_config_option
+from dcor_shared import s3, get_ckan_config_option
 from dcor_shared import RQJob  # noqa: F401
-
-from . import jobs
+import sqlalchemy
+from sqlalchemy import or_, orm
+
+from . import jobs, move, s3_inventory, s3_scan
+
+
+class JobProgress:
+    def __init__(self, total, done=0, interval=10):
+        """Report throughput and estimated time of arrival for CLI jobs"""
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self.count = 0
+        self.time_start = time.monotonic()
+        self.time_report = self.time_start
+
+    def update(self, count=1):
+        self.count += count
+        self.done += count
+        self.report()
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.time_report < self.interval:
+            return
+        self.time_report = now
+        rate = self.count / max(now - self.time_start, 1e-9)
+        if rate > 0 and self.total > self.done:
+            eta = datetime.timedelta(
+                seconds=round((self.total - self.done) / rate))
+        else:
+            eta = datetime.timedelta(0)
+        click.echo(f"Processed {self.done}/{self.total} "
+                   f"({rate:.2f}/s, ETA {eta})")
 
 
 def admin_context():
     return {'ignore_auth': True, 'user': 'default'}
 
 
-def iter_group_resources(group_id):
-    # print the list of resources of that group
-    query = model.meta.Session.query(model.package.Package). \
-        filter(model.group.group_table.c["id"] == group_id)
-    # copy-pasted from CKAN's model.group.Group.packages()
-    query = query.join(
-        model.group.member_table,
-        model.group.member_table.c["table_id"] == model.package.Package.id)
-    query = query.join(
-        model.group.group_table,
-        model.group.group_table.c["id"]
-        == model.group.member_table.c["group_id"])
-
-    for dataset in query.all():
+def plan_jobs_dcor_schemas(datasets, done=()):
+    """Print a histogram of pending dcor_schemas jobs for `datasets`
+
+    The `needs_run` predicates of the jobs only use resource metadata,
+    so this is fast and does not touch any S3 objects.
+    """
+    job_list = jobs.RQJob.get_all_job_methods_in_order(
+        ckanext="dcor_schemas")
+    pending = {job.name: 0 for job in job_list}
+    count = 0
+    for dataset in datasets:
+        ds_dict = {"id": dataset.id, "private": dataset.private}
         for resource in dataset.resources:
-            yield resource
+            if resource.id in done:
+                continue
+            count += 1
+            res_dict = resource.as_dict()
+            for job in job_list:
+                if jobs.needs_run(job.name, res_dict, ds_dict):
+                    pending[job.name] += 1
+
+    click.echo(f"Pending jobs for {count} resources:")
+    queues = {}
+    for job in job_list:
+        click.echo(f"{pending[job.name]:>10d}  {job.queue:<12s} {job.title}")
+        queues[job.queue] = queues.get(job.queue, 0) + pending[job.name]
+    click.echo("Pending jobs per queue:")
+    for queue in sorted(queues):
+        click.echo(f"{queues[queue]:>10d}  {queue}")
+
+
+def _init_job_worker():
+    """Initialize a forked worker process for running background jobs"""
+    # Do not share database or S3 connections with the parent process.
+    model.meta.engine.dispose(close=False)
+    model.Session.remove()
+    s3.get_s3.cache_clear()
+
+
+def _run_jobs_for_resource(res_dict):
+    """Run all dcor_schemas background jobs for one resource
+
+    Returns
+    -------
+    resource_id: str
+        ID of the resource
+    name: str
+        name of the resource
+    titles: list of str
+        titles of the jobs that changed something
+    error: str or None
+        error message if a job failed
+    """
+    job_list = jobs.RQJob.get_all_job_methods_in_order(
+        ckanext="dcor_schemas")
+    titles = []
+    error = None
+    try:
+        # write all changes with a single call to `package_revise`
+        with jobs.deferred_resource_patches(res_dict["package_id"]):
+            for job in job_list:
+                if job.method(res_dict):
+                    titles.append(job.title)
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        error = (f"{e.__class__.__name__} for {res_dict['name']}!\n"
+                 f"{traceback.format_exc()}")
+    return res_dict["id"], res_dict["name"], titles, error
+
+
+def _move_datasets_finalize(journal, entries):
+    """Move datasets to their new circles in one database transaction
+
+    `entries` are "copied" entries of a move journal (see
+    :func:`move.read_journal`). Each dataset gets its new owner
+    organization and the S3 URLs of its resources are updated.
+    """
+    if not entries:
+        return
+    try:
+        for entry in entries:
+            toolkit.get_action("package_owner_org_update")(
+                dict(admin_context(), defer_commit=True),
+                {"id": entry["dataset"],
+                 "organization_id": entry["circle_new"]})
+            revise_dict = {"match": {"id": entry["dataset"]}}
+            for res in model.Package.get(entry["dataset"]).resources:
+                url_old = res.extras.get("s3_url")
+                if url_old:
+                    revise_dict[f"update__resources__{res.id}"] = {
+                        "s3_url": url_old.replace(entry["circle_old"],
+                                                  entry["circle_new"])}
+            if len(revise_dict) > 1:
+                toolkit.get_action("package_revise")(
+                    dict(admin_context(), defer_commit=True), revise_dict)
+        model.repo.commit()
+    except BaseException:
+        model.repo.rollback()
+        raise
+
+    # make sure editing the database worked
+    circles_new = {entry["dataset"]: entry["circle_new"] for entry in entries}
+    query = model.Session.query(model.Package.id, model.Package.owner_org)
+    for row in query.filter(model.Package.id.in_(list(circles_new))):
+        assert row.owner_org == circles_new[row.id]
+        move.append_journal(journal, {"dataset": row.id,
+                                      "step": "db_updated"})
+    click.echo(f"...updated owner_org and s3_urls of {len(entries)} datasets")
+
+
+def _move_datasets_delete_old(journal, entries):
+    """Delete the old S3 objects of moved datasets
+
+    `entries` are entries of a move journal (see
+    :func:`move.read_journal`) for datasets that were moved in the
+    database.
+    """
+    if not entries:
+        return
+    objects = []
+    for entry in entries:
+        objects += entry["objects"]
+    move.delete_objects(objects)
+    for entry in entries:
+        move.append_journal(journal, {"dataset": entry["dataset"],
+                                      "step": "deleted"})
+    click.echo(f"...deleted {len(objects)} old S3 objects")
+
+
+def get_group_resource_ids():
+    """Return a dictionary with the resource IDs of all groups
+
+    The keys are group IDs and the values are sets of resource IDs.
+    The same resources as in :func:`iter_group_resources` are taken into
+    account (all datasets that are or were members of a group and their
+    resources that are not deleted), but only one database query is
+    made for all groups.
+    """
+    group_resources = {}
+    for row in iter_group_resources():
+        group_resources.setdefault(row.group_id, set()).add(row.resource_id)
+    return group_resources
+
+
+def get_unused_groups(created_before):
+    """Return all active groups without children and active datasets
+
+    Only groups created before `created_before` are returned. All groups
+    are determined with a single database query.
+
+    Returns
+    -------
+    groups: list of tuple
+        list of `(group_id, is_organization)`
+    """
+    group = model.Group
+    child = orm.aliased(model.Group)
+    child_member = orm.aliased(model.Member)
+    package_member = orm.aliased(model.Member)
+    # children as in `model.Group.get_children_groups`
+    has_children = (
+        sqlalchemy.exists()
+        .where(child_member.table_id == group.id)
+        .where(child_member.table_name == "group")
+        .where(child_member.state == model.core.State.ACTIVE)
+        .where(child.id == child_member.group_id)
+        .where(child.type == "group")
+        .where(child.state == model.core.State.ACTIVE)
+    )
+    has_datasets = (
+        sqlalchemy.exists()
+        .where(package_member.group_id == group.id)
+        .where(package_member.state == model.core.State.ACTIVE)
+        .where(model.Package.id == package_member.table_id)
+        .where(model.Package.state == model.core.State.ACTIVE)
+    )
+    query = (
+        model.meta.Session.query(group.id, group.is_organization)
+        .filter(group.state == model.core.State.ACTIVE)
+        .filter(group.created < created_before)
+        .filter(~has_children)
+        .filter(~has_datasets)
+        .order_by(group.created)
+    )
+    return [(row.id, row.is_organization) for row in query]
+
+
+def purge_datasets(dataset_ids):
+    """Purge multiple datasets and their S3 artifacts
+
+    This does the same as CKAN's `dataset_purge` action, but for all
+    datasets in one database transaction and without the action and
+    authorization overhead. The S3 artifacts of all resources of the
+    datasets are deleted afterward with batched `DeleteObjects` requests.
+    """
+    if not dataset_ids:
+        return
+    session = model.meta.Session
+    # S3 objects of all resources
+    bucket_name = get_ckan_config_option("dcor_object_store.bucket_name")
+    objects = []
+    query = (
+        session.query(model.Resource.id, model.Package.owner_org)
+        .join(model.Package, model.Package.id == model.Resource.package_id)
+        .filter(model.Package.id.in_(dataset_ids))
+    )
+    for rid, owner_org in query:
+        if owner_org:
+            for art in move.ARTIFACTS:
+                objects.append(
+                    [bucket_name.format(organization_id=owner_org),
+                     f"{art}/{rid[:3]}/{rid[3:6]}/{rid[6:]}"])
+
+    # copied from CKAN's `dataset_purge`
+    session.query(model.Member) \
+        .filter(model.Member.table_id.in_(dataset_ids)) \
+        .filter(model.Member.table_name == 'package') \
+        .delete(synchronize_session=False)
+    session.query(model.PackageRelationship).filter(
+        or_(model.PackageRelationship.subject_package_id.in_(dataset_ids),
+            model.PackageRelationship.object_package_id.in_(dataset_ids))
+    ).delete(synchronize_session=False)
+    # Purge via the ORM, so that resources are purged as well and
+    # the search index is updated.
+    for pkg in session.query(model.Package).filter(
+            model.Package.id.in_(dataset_ids)):
+        pkg.purge()
+    model.repo.commit_and_remove()
+
+    move.delete_objects(objects)
+
+
+def purge_groups(group_ids):
+    """Purge multiple collections and circles
+
+    This does the same as CKAN's `group_purge` and `organization_purge`
+    actions, but for all groups in one database transaction and without
+    the action and authorization overhead.
+    """
+    if not group_ids:
+        return
+    session = model.meta.Session
+    # copied from CKAN's `_group_or_org_purge`
+    pkg_table = model.package_table
+    owned = sqlalchemy.and_(pkg_table.c["owner_org"].in_(group_ids),
+                            pkg_table.c["state"] != model.core.State.DELETED)
+    if session.query(pkg_table).filter(owned).count():
+        if not authz.check_config_permission(
+                'ckan.auth.create_unowned_dataset'):
+            raise logic.ValidationError({
+                'message': 'Organization cannot be purged while it '
+                           'still has datasets'})
+        session.execute(pkg_table.update().where(owned).values(
+            owner_org=None))
+    session.query(model.Member).filter(
+        or_(model.Member.group_id.in_(group_ids),
+            model.Member.table_id.in_(group_ids))
+    ).delete(synchronize_session=False)
+    for grp in session.query(model.Group).filter(
+            model.Group.id.in_(group_ids)):
+        grp.purge()
+    model.repo.commit_and_remove()
+
+
+def get_zombie_users(last_activity_weeks=12):
+    """Return all users without datasets and without recent activity
+
+    Sysadmins and users with datasets (including private and draft
+    datasets, but not deleted datasets) are ignored. All users are
+    determined with a
+    single database query (outer join with the package table).
+
+    Returns
+    -------
+    users: list of dict
+        dictionaries with the keys "id", "name", "created", and
+        "last_active" (ISO format strings or None)
+    """
+    threshold = (datetime.datetime.now(datetime.timezone.utc)
+                 - datetime.timedelta(weeks=last_activity_weeks))
+    # `last_active` is stored as naive UTC time
+    threshold = threshold.replace(tzinfo=None)
+    query = (
+        model.meta.Session.query(model.User.id,
+                                 model.User.name,
+                                 model.User.created,
+                                 model.User.last_active)
+        .outerjoin(model.Package,
+                   sqlalchemy.and_(
+                       model.Package.creator_user_id == model.User.id,
+                       model.Package.state != model.core.State.DELETED))
+        .filter(model.User.sysadmin.is_(False))
+        # users without datasets
+        .filter(model.Package.id.is_(None))
+        # users without recent activity
+        .filter(or_(model.User.last_active.is_(None),
+                    model.User.last_active < threshold))
+        .order_by(model.User.name)
+    )
+    return [{"id": row.id,
+             "name": row.name,
+             "created": row.created.isoformat() if row.created else None,
+             "last_active": (row.last_active.isoformat()
+                             if row.last_active else None),
+             } for row in query]
+
+
+def iter_group_resources(group_id=None, yield_per=10000):
+    """Iterate over the resources of a group (or of all groups)
+
+    All datasets that are or were members of the group are taken into
+    account (including draft and deleted datasets), but deleted resources
+    are ignored. Only the IDs are loaded from the database (one query with
+    `yield_per`), so memory usage does not depend on the size of a group.
+
+    Yields
+    ------
+    row: sqlalchemy.engine.Row
+        row with the attributes "group_id", "package_id", "resource_id",
+        and "state" (state of the resource)
+    """
+    member_table = model.group.member_table
+    query = (
+        model.meta.Session.query(
+            member_table.c["group_id"].label("group_id"),
+            model.Resource.package_id.label("package_id"),
+            model.Resource.id.label("resource_id"),
+            model.Resource.state.label("state"))
+        .join(model.Resource,
+              model.Resource.package_id == member_table.c["table_id"])
+        .filter(model.Resource.state != model.core.State.DELETED)
+    )
+    if group_id is not None:
+        query = query.filter(member_table.c["group_id"] == group_id)
+    yield from query.yield_per(yield_per)
 
 
 @click.command()
 @click.argument("dataset")
 @click.argument("circle")
-def dcor_move_dataset_to_circle(dataset, circle):
+@click.option('--jobs', 'num_jobs', default=move.COPY_JOBS,
+              help='Number of concurrent S3 copy operations')
+def dcor_move_dataset_to_circle(dataset, circle, num_jobs=move.COPY_JOBS):
     """Move a dataset to a different circle
 
     Moving a dataset to a new circle implies:
     - copying the resource files from the old S3 bucket to the new
-      S3 bucket (verifying SHA256sum)
+      S3 bucket (server-side, verifying size and ETag)
     - setting the public flag (if applicable)
     - setting the "owner_org" of the dataset to the new circle ID
     - updating the "s3_url" metadata of each resource to the new S3 URL
@@ -68,36 +425,15 @@ def dcor_move_dataset_to_circle(dataset, circle):
         print(f"Dataset already in {cr_new['id']}")
         return
 
-    s3_client, _, _ = s3.get_s3()
-
     # Copy resource files to new bucket
-    to_delete = []
-    for rs_dict in ds_dict["resources"]:
-        rid = rs_dict["id"]
-        rsha = rs_dict["sha256"]
-        for art in ["condensed", "preview", "resource"]:
-            if not s3cc.artifact_exists(rid, art):
-                continue
-            bucket_old, obj = s3cc.get_s3_bucket_object_for_artifact(rid, art)
-            bucket_new = bucket_old.replace(cr_old["id"], cr_new["id"])
-            assert bucket_old != bucket_new, "sanity check"
-            # copy the resource to the destination bucket
-            s3.require_bucket(bucket_new)
-            copy_source = {'Bucket': bucket_old, 'Key': obj}
-            s3_client.copy(copy_source, bucket_new, obj)
-            # verify checksum
-            if art == "resource":
-                assert s3.compute_checksum(bucket_new, obj) == rsha
-            else:
-                assert s3.compute_checksum(bucket_new, obj) \
-                    == s3.compute_checksum(bucket_old, obj)
-            # set to public if applicable
-            if not ds_dict["private"]:
-                s3.make_object_public(bucket_name=bucket_new,
-                                      object_name=obj,
-                                      missing_ok=False)
-            print(f"...copied S3 object {rid}:{art}")
-            to_delete.append([bucket_old, obj])
+    to_delete = move.copy_dataset_artifacts(
+        ds_dict=ds_dict,
+        circle_old=cr_old["id"],
+        circle_new=cr_new["id"],
+        num_jobs=num_jobs,
+        callback=lambda rid, art, size: print(
+            f"...copied S3 object {rid}:{art} ({size} bytes)"),
+    )
 
     # Set owner org of dataset to new circle ID
     toolkit.get_action("package_owner_org_update")(
@@ -128,52 +464,191 @@ def dcor_move_dataset_to_circle(dataset, circle):
         assert res["s3_url"].count(cr_new["id"])
 
     # Delete the resource files in the old S3 bucket
-    for bucket, key in to_delete:
-        s3_client.delete_object(Bucket=bucket, Key=key)
+    move.delete_objects(to_delete)
     print("...deleted old S3 objects")
 
 
+@click.command()
+@click.argument("circle")
+@click.option('--source-circle', default=None,
+              help='Move all datasets of this circle')
+@click.option('--ids-file',
+              type=click.Path(exists=True,
+                              dir_okay=False,
+                              resolve_path=True,
+                              path_type=pathlib.Path),
+              default=None,
+              help='Move all datasets listed in this file (one dataset '
+                   + 'ID or name per line)')
+@click.option('--journal',
+              type=click.Path(dir_okay=False,
+                              resolve_path=True,
+                              path_type=pathlib.Path),
+              required=True,
+              help='Journal file (JSON lines) recording the progress; '
+                   + 'Use the same file to resume an interrupted run.')
+@click.option('--jobs', 'num_jobs', default=move.COPY_JOBS,
+              help='Number of concurrent S3 copy operations')
+@click.option('--batch-size', default=50,
+              help='Number of datasets updated in one database transaction')
+@click.option('--rollback', is_flag=True,
+              help='Roll back an interrupted run instead of resuming it')
+def dcor_move_datasets_to_circle(circle, source_circle=None, ids_file=None,
+                                 journal=None, num_jobs=move.COPY_JOBS,
+                                 batch_size=50, rollback=False):
+    """Move many datasets to a different circle
+
+    The datasets are either all datasets of `--source-circle` or the
+    datasets listed in `--ids-file`. The datasets are processed in
+    batches. For each batch, the S3 objects of all datasets are copied
+    concurrently, the owner organizations and S3 URLs of all datasets
+    are updated in one database transaction, and the old S3 objects
+    are deleted. Every step is recorded in the journal.
+
+    If a run is interrupted, calling this command with the same journal
+    file rolls the datasets forward (datasets whose objects were copied
+    are moved in the database and the old objects are deleted). With
+    `--rollback`, the copied objects of datasets that were not yet
+    moved in the database are deleted instead.
+    """
+    state = move.read_journal(journal)
+
+    if rollback:
+        copied = [e for e in state.values() if e["step"] == "copied"]
+        to_remove = []
+        for entry in copied:
+            for bucket_old, obj in entry["objects"]:
+                to_remove.append([bucket_old.replace(entry["circle_old"],
+                                                     entry["circle_new"]),
+                                  obj])
+        move.delete_objects(to_remove)
+        for entry in copied:
+            move.append_journal(journal, {"dataset": entry["dataset"],
+                                          "step": "rolled_back"})
+            click.echo(f"Rolled back {entry['dataset']}")
+        for entry in state.values():
+            if entry["step"] == "db_updated":
+                click.echo(f"Cannot roll back {entry['dataset']} (already "
+                           f"moved in the database), please resume instead",
+                           err=True)
+        return
+
+    cr_new = toolkit.get_action("organization_show")(
+        admin_context(), {"id": circle})
+
+    # Roll forward datasets of an interrupted run
+    _move_datasets_finalize(
+        journal, [e for e in state.values() if e["step"] == "copied"])
+    _move_datasets_delete_old(
+        journal, [e for e in state.values() if e["step"] == "db_updated"])
+
+    # Determine the datasets to move
+    packages = model.Session.query(model.Package.id)
+    if source_circle is not None:
+        cr_old = toolkit.get_action("organization_show")(
+            admin_context(), {"id": source_circle})
+        packages = packages.filter(model.Package.owner_org == cr_old["id"])
+    elif ids_file is not None:
+        ids = [ii.strip() for ii in ids_file.read_text().split("\n")
+               if ii.strip()]
+        packages = packages.filter(or_(model.Package.id.in_(ids),
+                                       model.Package.name.in_(ids)))
+    else:
+        raise click.UsageError("Please specify either --source-circle "
+                               "or --ids-file")
+    packages = packages.filter(model.Package.owner_org != cr_new["id"])
+    dataset_ids = [row.id for row in packages
+                   if row.id not in state
+                   or state[row.id]["step"] == "rolled_back"]
+    click.echo(f"Moving {len(dataset_ids)} datasets to {cr_new['id']}")
+    progress = JobProgress(total=len(dataset_ids), interval=0)
+
+    for ii in range(0, len(dataset_ids), batch_size):
+        entries = {}
+        tasks = []
+        for ds_id in dataset_ids[ii:ii + batch_size]:
+            pkg = model.Package.get(ds_id)
+            ds_dict = {
+                "id": pkg.id,
+                "private": pkg.private,
+                "resources": [{"id": res.id,
+                               "sha256": res.extras.get("sha256")}
+                              for res in pkg.resources],
+            }
+            entries[ds_id] = {"dataset": ds_id,
+                              "step": "copied",
+                              "circle_old": pkg.owner_org,
+                              "circle_new": cr_new["id"],
+                              "objects": [],
+                              }
+            tasks += move.get_dataset_copy_tasks(
+                ds_dict, circle_old=pkg.owner_org, circle_new=cr_new["id"])
+
+        # S3 copies of all datasets in this batch are done concurrently
+        copied = move.copy_artifacts(
+            tasks,
+            num_jobs=num_jobs,
+            callback=lambda task, size: click.echo(
+                f"...copied S3 object {task['resource_id']}:"
+                f"{task['artifact']} ({size} bytes)"))
+        for task in copied:
+            entries[task["dataset_id"]]["objects"].append(
+                [task["bucket_old"], task["object_name"]])
+        for entry in entries.values():
+            move.append_journal(journal, entry)
+
+        _move_datasets_finalize(journal, list(entries.values()))
+        _move_datasets_delete_old(journal, list(entries.values()))
+        progress.update(len(entries))
+    click.echo("Done!")
+
+
 @click.command()
 @click.option('--older-than-days', default=21,
               help='Only prune datasets that were created before a given '
                    + 'number of days (set to -1 to prune all)')
 @click.option('--dry-run', is_flag=True,
               help='Do not actually remove anything')
-def dcor_prune_draft_datasets(older_than_days=21, dry_run=False):
-    """Remove draft datasets from the CKAN database"""
-    # Iterate over all packages
-    # data_dict will be overridden each time it is used
+@click.option('--batch-size', default=100,
+              help='Number of datasets purged in one database transaction')
+def dcor_prune_draft_datasets(older_than_days=21, dry_run=False,
+                              batch_size=100):
+    """Remove draft datasets from the CKAN database
+
+    The S3 artifacts of the removed datasets are deleted as well.
+    """
+    threshold = (datetime.datetime.now()
+                 - datetime.timedelta(days=older_than_days))
     query = (
-        model.meta.Session.query(model.package.Package)
-        # all inactive datasets
-        .filter(model.package.Package.state != model.core.State.ACTIVE)
+        model.meta.Session.query(model.Package.id, model.Package.name)
+        .filter(model.Package.state == "draft")
+        .filter(model.Package.metadata_modified < threshold)
+        .order_by(model.Package.id)
+    )
+    # all inactive datasets that are not pruned
+    ds_ignored = (
+        model.meta.Session.query(model.Package.id)
+        .filter(model.Package.state != model.core.State.ACTIVE)
+        .count()
     )
 
     ds_found = 0
-    ds_ignored = 0
-
-    package_delete = logic.get_action('package_delete')
-    dataset_purge = logic.get_action('dataset_purge')
-
-    for dataset in query.all():
-        if not dataset.state == "draft":
-            ds_ignored += 1
-            continue
-        threshold = (datetime.datetime.now()
-                     - datetime.timedelta(days=older_than_days))
-        if dataset.metadata_modified < threshold:
-            ds_found += 1
-            click.secho(f"Found dataset {dataset.name}")
-            if not dry_run:
-                package_delete(context=admin_context(),
-                               data_dict={'id': dataset.id})
-                dataset_purge(context=admin_context(),
-                              data_dict={'id': dataset.id})
-        else:
-            ds_ignored += 1
+    last_id = ""
+    while True:
+        # Keyset pagination, because purging commits the session.
+        batch = query.filter(model.Package.id > last_id).limit(
+            batch_size).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        for row in batch:
+            click.secho(f"Found dataset {row.name}")
+        ds_found += len(batch)
+        if not dry_run:
+            purge_datasets([row.id for row in batch])
 
     click.secho(f"Number of draft datasets found:   {ds_found}")
-    click.secho(f"Number of draft datasets ignored: {ds_ignored}")
+    click.secho(f"Number of draft datasets ignored: {ds_ignored - ds_found}")
     click.secho("Done!")
 
 
@@ -185,48 +660,140 @@ def dcor_prune_draft_datasets(older_than_days=21, dry_run=False):
               help='Keep buckets that do not represent a circle')
 @click.option('--dry-run', is_flag=True,
               help='Do not actually remove anything')
+@click.option('--jobs', 'num_jobs', default=s3_scan.SCAN_JOBS,
+              help='Number of concurrent S3 list requests')
+@click.option('--max-delete-rate', default=s3_scan.DELETE_RATE,
+              help='Maximum number of S3 objects deleted per second')
+@click.option('--snapshot',
+              type=click.Path(dir_okay=False,
+                              resolve_path=True,
+                              path_type=pathlib.Path),
+              default=None,
+              help='SQLite file in which an inventory of all S3 objects '
+                   + 'of all circles is stored after listing all buckets')
+@click.option('--incremental', is_flag=True,
+              help='Do not list all buckets, but only the objects after '
+                   + 'the last key of each shard in the inventory snapshot, '
+                   + 'add them to the snapshot, and check the snapshot '
+                   + 'against the database')
 def dcor_prune_orphaned_s3_artifacts(older_than_days=21,
                                      keep_orphan_buckets=False,
-                                     dry_run=False):
-    """Remove resources from S3 that are not in the CKAN database"""
+                                     dry_run=False,
+                                     num_jobs=s3_scan.SCAN_JOBS,
+                                     max_delete_rate=s3_scan.DELETE_RATE,
+                                     snapshot=None,
+                                     incremental=False):
+    """Remove resources from S3 that are not in the CKAN database
+
+    With `--snapshot`, an inventory of all S3 objects is stored after
+    each full run. Objects that are too young to be pruned are stored
+    as well, so that a later run can prune them. Subsequent runs with
+    `--incremental` only list the objects after the last key of each
+    shard in the inventory (`StartAfter`), add them to the inventory,
+    and check the inventory against the resources in the database,
+    which is much faster than listing all buckets. Since S3 does not
+    offer a list of changed objects, new objects whose keys sort
+    before the last key of their shard are only found by a full run.
+    """
     s3_client, _, _ = s3.get_s3()
+    time_start = time.monotonic()
+    if incremental and (snapshot is None or not snapshot.exists()):
+        raise click.UsageError("--incremental requires an existing "
+                               "inventory snapshot (--snapshot)")
+    inventory = None if snapshot is None else \
+        s3_inventory.InventorySnapshot(snapshot)
     buckets_exist = sorted(s3.iter_buckets())
-    buckets_used = []
-    obj_found = 0
+    # Resource IDs of all circles (one database query)
+    circle_resources = get_group_resource_ids()
+    buckets_used = {}
     for grp in model.Group.all():
         if grp.is_organization:
             org_bucket = get_ckan_config_option(
                 "dcor_object_store.bucket_name").format(organization_id=grp.id)
-            buckets_used.append(org_bucket)
-            # List of resources in that circle
-            resources = [r.id for r in iter_group_resources(grp.id)]
-            # Iterate over present objects and remove when necessary
-            for obj in s3.iter_bucket_objects(
-                    bucket_name=org_bucket,
-                    older_than_days=older_than_days):
-                rid = "".join(obj.split("/")[1:])
-                if rid not in resources:
-                    obj_found += 1
-                    click.secho(f"Found object {org_bucket}:{obj}")
-                    if not dry_run:
-                        s3_client.delete_object(Bucket=org_bucket,
-                                                Key=obj)
+            buckets_used[org_bucket] = grp.id
+
+    obj_scanned = 0
+    if incremental:
+        # Add new objects to the inventory (also for dry runs; the
+        # changes are rolled back below).
+        obj_new = 0
+        for bucket_name, obj, size, last_modified in \
+                s3_scan.iter_bucket_objects(
+                    [bn for bn in buckets_used if bn in buckets_exist],
+                    older_than_days=-1,
+                    num_jobs=num_jobs,
+                    start_after=inventory.get_shard_cursors()):
+            obj_scanned += 1
+            if (bucket_name, obj) not in inventory:
+                obj_new += 1
+                inventory.add(bucket_name, obj, size, last_modified)
+        click.secho(f"Checking inventory snapshot from "
+                    f"{inventory.time_created} ({len(inventory)} objects, "
+                    f"{obj_new} new)")
+        objects = inventory.iter_objects(older_than_days=older_than_days)
+    else:
+        if inventory is not None and not dry_run:
+            inventory.clear()
+        objects = s3_scan.iter_bucket_objects(
+            [bn for bn in buckets_used if bn in buckets_exist],
+            # The inventory must contain all objects
+            older_than_days=-1 if inventory is not None else older_than_days,
+            num_jobs=num_jobs)
+
+    deleter = s3_scan.BatchDeleter(max_rate=max_delete_rate, dry_run=dry_run)
+    obj_found = []
+    threshold = (datetime.datetime.now(datetime.timezone.utc)
+                 - datetime.timedelta(days=older_than_days))
+    # Iterate over present objects in all circle buckets
+    for bucket_name, obj, size, last_modified in objects:
+        obj_scanned += 1
+        rid = "".join(obj.split("/")[1:])
+        circle_id = buckets_used.get(bucket_name)
+        if (rid not in circle_resources.get(circle_id, ())
+                and last_modified <= threshold):
+            obj_found.append([bucket_name, obj])
+            click.secho(f"Found object {bucket_name}:{obj}")
+            deleter.add(bucket_name, obj, size)
+        elif inventory is not None and not incremental and not dry_run:
+            # Also store orphans that are too young to be pruned, so
+            # that an incremental run can prune them later.
+            inventory.add(bucket_name, obj, size, last_modified)
+    deleter.flush()
+    if inventory is not None and incremental and not dry_run:
+        for bucket_name, obj in obj_found:
+            inventory.remove(bucket_name, obj)
 
     # Remove orphaned buckets
     if not keep_orphan_buckets:
-        for bucket_name in buckets_exist:
-            if bucket_name not in buckets_used:
-                click.secho(f"Found bucket {bucket_name}")
-                if not dry_run:
-                    for obj in s3.iter_bucket_objects(bucket_name):
-                        s3_client.delete_object(Bucket=bucket_name,
-                                                Key=obj)
-                    try:
-                        s3_client.delete_bucket(Bucket=bucket_name)
-                    except s3_client.exceptions.NoSuchBucket:
-                        # bucket has been deleted in the meantime
-                        pass
-    click.secho(f"Number of orphaned objects found: {obj_found}")
+        buckets_orphaned = [bn for bn in buckets_exist
+                            if bn not in buckets_used]
+        for bucket_name in buckets_orphaned:
+            click.secho(f"Found bucket {bucket_name}")
+        if not dry_run:
+            for bucket_name, obj, size, _ in s3_scan.iter_bucket_objects(
+                    buckets_orphaned, older_than_days=-1, num_jobs=num_jobs):
+                obj_scanned += 1
+                deleter.add(bucket_name, obj, size)
+                if inventory is not None:
+                    inventory.remove(bucket_name, obj)
+            deleter.flush()
+            for bucket_name in buckets_orphaned:
+                try:
+                    s3_client.delete_bucket(Bucket=bucket_name)
+                except s3_client.exceptions.NoSuchBucket:
+                    # bucket has been deleted in the meantime
+                    pass
+    if inventory is not None:
+        if dry_run:
+            inventory.rollback()
+        else:
+            inventory.commit()
+    duration = max(time.monotonic() - time_start, 1e-9)
+    click.secho(f"Number of orphaned objects found: {len(obj_found)}")
+    click.secho(f"Scanned {obj_scanned} objects "
+                f"({obj_scanned / duration:.1f} objects/s)")
+    click.secho(f"{'Reclaimable' if dry_run else 'Reclaimed'}: "
+                f"{deleter.count} objects, {deleter.size} bytes")
     click.secho("Done!")
 
 
@@ -236,61 +803,29 @@ def dcor_prune_orphaned_s3_artifacts(older_than_days=21,
                    'a given number of months (set to -1 to delete all)')
 @click.option('--dry-run', is_flag=True,
               help='Do not actually delete anything')
+@click.option('--batch-size', default=100,
+              help='Number of groups purged in one database transaction')
 def dcor_purge_unused_collections_and_circles(
         modified_before_months: int = 24,
-        dry_run: bool = False):
+        dry_run: bool = False,
+        batch_size: int = 100):
     """Purge old collections and circles that don't contain any datasets"""
-    # Iterate over all collections
-    for group in model.Group.all():
-        # Check group children
-        if group.get_children_groups():
-            print(f"Ignoring group '{group.id}' with children")
-            continue
-
-        # Check group age
-        if group.created >= (
-                datetime.datetime.now()
-                - datetime.timedelta(days=31 * modified_before_months)):
-            # Group not old enough
-            continue
-
-        # Does this group contain any datasets?
-        query = (
-            model.meta.Session.query(model.package.Package)
-            # table with all active datasets
-            .filter(model.package.Package.state == model.core.State.ACTIVE)
-            # group table of the current group
-            .filter(model.group.group_table.c["id"] == group.id)
-            # member table with all active members
-            .filter(model.group.member_table.c["state"] == 'active')
-            # intersection of the members and package tables
-            .join(model.group.member_table,
-                  model.group.member_table.c["table_id"]
-                  == model.package.Package.id)
-            # intersection of the group table and the members table
-            .join(model.group.group_table,
-                  model.group.group_table.c["id"]
-                  == model.group.member_table.c["group_id"])
-            # we only need one
-            .limit(1)
-            )
-
-        if not query.count():
-            if group.is_organization:
-                print(f"Delete circle {group.id}")
-                purge_method = logic.action.delete.organization_purge
+    unused = get_unused_groups(
+        created_before=datetime.datetime.now()
+        - datetime.timedelta(days=31 * modified_before_months))
+    click.echo(f"Found {len(unused)} unused collections and circles")
+    progress = JobProgress(total=len(unused), interval=0)
+
+    for ii in range(0, len(unused), batch_size):
+        batch = unused[ii:ii + batch_size]
+        for group_id, is_organization in batch:
+            if is_organization:
+                click.echo(f"Delete circle {group_id}")
             else:
-                print(f"Delete collection {group.id}")
-                purge_method = logic.action.delete.group_purge
-
-            if not dry_run:
-                # The `group_purge` method makes sure that all the memberships
-                # (users) are deleted before removing the group.
-                purge_method({'ignore_auth': True,
-                              'user': 'default',
-                              'model': model},
-                             {"id": group.id}
-                             )
+                click.echo(f"Delete collection {group_id}")
+        if not dry_run:
+            purge_groups([group_id for group_id, _ in batch])
+        progress.update(len(batch))
 
 
 @click.command()
@@ -322,77 +857,117 @@ def list_group_resources(group_id_or_name):
         click.secho(f"Group '{group_id_or_name}' not found", fg="red")
         return sys.exit(1)
     else:
-        for resource in iter_group_resources(group.id):
-            click.echo(resource.id)
+        for row in iter_group_resources(group.id):
+            click.echo(row.resource_id)
 
 
 @click.option('--last-activity-weeks', default=12,
               help='Only list users with no activity for X weeks')
+@click.option('--format', 'output_format', default="text",
+              type=click.Choice(["text", "json", "csv"]),
+              help='Output format; "text" only lists the user names')
 @click.command()
-def list_zombie_users(last_activity_weeks=12):
+def list_zombie_users(last_activity_weeks=12, output_format="text"):
     """List zombie users (no activity, no datasets)"""
-    users = model.User.all()
-    for user in users:
-        # user is admin?
-        if user.sysadmin:
-            continue
-        # user has datasets?
-        if user.number_created_packages(include_private_and_draft=True) != 0:
-            # don't list users with datasets
-            continue
-        # user has been active?
-        if (user.last_active is not None
-                and user.last_active.timestamp() >= (
-                    time.time() - 60*60*24*7*last_activity_weeks)):
-            # don't delete users that did things
-            continue
-        click.echo(user.name)
+    users = get_zombie_users(last_activity_weeks)
+    if output_format == "text":
+        for user in users:
+            click.echo(user["name"])
+    elif output_format == "json":
+        click.echo(json.dumps(users, indent=2))
+    else:
+        writer = csv.DictWriter(click.get_text_stream("stdout"),
+                                fieldnames=["id", "name", "created",
+                                            "last_active"])
+        writer.writeheader()
+        writer.writerows(users)
 
 
 @click.command()
 @click.option('--modified-days', default=-1,
               help='Only run for datasets modified within this number of days '
                    + 'in the past. Set to -1 to apply to all datasets.')
-def run_jobs_dcor_schemas(modified_days=-1):
+@click.option('--workers', default=1,
+              help='Number of worker processes for running the jobs of '
+                   + 'different resources in parallel')
+@click.option('--checkpoint',
+              type=click.Path(dir_okay=False,
+                              resolve_path=True,
+                              path_type=pathlib.Path),
+              default=None,
+              help='Path to a checkpoint file to which the IDs of all '
+                   + 'processed resources are written. If the file exists, '
+                   + 'these resources are skipped (resume a previous run).')
+@click.option('--plan', is_flag=True,
+              help='Do not run any jobs, only print the number of resources '
+                   + 'for which each job would change metadata (determined '
+                   + 'from the resource metadata without accessing S3)')
+def run_jobs_dcor_schemas(modified_days=-1, workers=1, checkpoint=None,
+                          plan=False):
     """Set .rtdc metadata and SHA256 sums and for all resources
 
     This also happens for draft datasets.
     """
     datasets = model.Session.query(model.Package)
+    resources = (model.Session.query(model.Resource.id)
+                 .join(model.Package,
+                       model.Package.id == model.Resource.package_id)
+                 .filter(model.Resource.state != model.core.State.DELETED))
 
     if modified_days >= 0:
         # Search only the last `days` days.
         past = datetime.date.today() - datetime.timedelta(days=modified_days)
         past_str = time.strftime("%Y-%m-%d", past.timetuple())
         datasets = datasets.filter(model.Package.metadata_modified >= past_str)
+        resources = resources.filter(
+            model.Package.metadata_modified >= past_str)
 
-    job_list = jobs.RQJob.get_all_job_methods_in_order(
-        ckanext="dcor_schemas")
+    done = set()
+    if checkpoint is not None and checkpoint.exists():
+        done.update(checkpoint.read_text().split())
+        click.echo(f"Resuming from checkpoint ({len(done)} resources done)")
 
-    nl = False  # new line character
-    for dataset in datasets:
-        nl = False
-        click.echo(f"Checking dataset {dataset.id}\r", nl=False)
+    def iter_resource_dicts():
+        for dataset in datasets:
+            for resource in dataset.resources:
+                if resource.id not in done:
+                    yield resource.as_dict()
 
-        for resource in dataset.resources:
-            res_dict = resource.as_dict()
-            try:
-                for job in job_list:
-                    if job.method(res_dict):
-                        if not nl:
-                            click.echo("")
-                            nl = True
-                        click.echo(f"OK: {job.title} for {resource.name}")
-            except KeyboardInterrupt:
-                raise
-            except BaseException as e:
-                click.echo(
-                    f"\n{e.__class__.__name__} for {res_dict['name']}!",
-                    err=True)
-                click.echo(traceback.format_exc(), err=True)
-                nl = True
-    if not nl:
-        click.echo("")
+    total = resources.count()
+
+    if plan:
+        plan_jobs_dcor_schemas(datasets, done=done)
+        return
+
+    progress = JobProgress(total=total, done=len(done))
+
+    if workers > 1:
+        # Query the database before forking and do not take a checked-out
+        # connection of the scoped session into the worker processes.
+        res_dicts = list(iter_resource_dicts())
+        model.Session.remove()
+        pool = multiprocessing.get_context("fork").Pool(
+            processes=workers,
+            initializer=_init_job_worker)
+        results = pool.imap_unordered(_run_jobs_for_resource, res_dicts)
+    else:
+        pool = None
+        results = map(_run_jobs_for_resource, iter_resource_dicts())
+
+    try:
+        for rid, name, titles, error in results:
+            for title in titles:
+                click.echo(f"OK: {title} for {name}")
+            if error:
+                click.echo(error, err=True)
+            elif checkpoint is not None:
+                with checkpoint.open("a") as fd:
+                    fd.write(rid + "\n")
+            progress.update()
+    finally:
+        if pool is not None:
+            pool.terminate()
+    progress.report(force=True)
     click.echo("Done!")
 
 
@@ -426,6 +1001,7 @@ def send_mail(recipient, subject=None, file_body=None):
 def get_commands():
     return [
         dcor_move_dataset_to_circle,
+        dcor_move_datasets_to_circle,
         dcor_prune_draft_datasets,
         dcor_prune_orphaned_s3_artifacts,
         dcor_purge_unused_collections_and_circles,
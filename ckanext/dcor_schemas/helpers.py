@@ -13,6 +13,50 @@ LICENSE_RATING = {
 }
 
 
+def get_package_dict(context, package_id):
+    """Return the (cached) `package_show` dictionary of a dataset
+
+    During a single action (e.g. `package_revise`), the auth functions,
+    validators, and plugin hooks all need the current dataset dictionary.
+    The dictionary is cached in the action context (the cache is shared
+    by all copies of the context made after the first call) and
+    invalidated when the dataset is modified (see
+    :func:`invalidate_package_dict`) or when its `metadata_modified`
+    changes. The returned dictionary must not be modified.
+    """
+    cache = context.setdefault("dcor_schemas_package_show_cache", {})
+    cache_key = (context.get("user"),
+                 bool(context.get("ignore_auth")),
+                 package_id)
+    pkg = model.Package.get(package_id)
+    if pkg is not None and cache_key in cache:
+        metadata_modified, pkg_dict = cache[cache_key]
+        if metadata_modified == pkg.metadata_modified:
+            return pkg_dict
+
+    show_context = {
+        'model': context.get('model', model),
+        'session': context.get('session', model.Session),
+        'user': context.get('user'),
+        'auth_user_obj': context.get('auth_user_obj'),
+        'ignore_auth': context.get('ignore_auth', False),
+    }
+    pkg_dict = logic.get_action('package_show')(show_context,
+                                                {'id': package_id})
+    if pkg is not None:
+        cache[cache_key] = (pkg.metadata_modified, pkg_dict)
+    return pkg_dict
+
+
+def invalidate_package_dict(context, package_id=None):
+    """Remove a dataset (or all datasets) from the `package_show` cache"""
+    cache = context.get("dcor_schemas_package_show_cache")
+    if cache:
+        for key in list(cache):
+            if package_id is None or key[2] == package_id:
+                cache.pop(key)
+
+
 def get_reference_dict(value):
     refs = [a.strip() for a in value.split(",") if a.strip()]
     rdict = {"arxiv": [],
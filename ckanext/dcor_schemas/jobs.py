@@ -1,19 +1,55 @@
+import contextlib
 import datetime
 import json
 import logging
 import time
+import traceback
+import uuid
 
-from ckan import logic
+from ckan import logic, model
+from ckan.lib.redis import connect_to_redis
+import ckan.plugins.toolkit as toolkit
 import dclab
 from dcor_shared import (
     DC_MIME_TYPES, get_ckan_config_option, get_dc_instance,
-    rqjob_register, s3, s3cc, wait_for_resource,
+    rqjob_register, s3cc, wait_for_resource,
 )
 from dcor_shared import RQJob  # noqa: F401
+from redis.exceptions import LockError, ResponseError
+import rq
+
+from . import checksum, s3_meta
 
 
 logger = logging.getLogger(__name__)
 
+#: Time in seconds a background job waits for concurrent jobs to add
+#: their resource patches before writing them to the database (only
+#: if patches of other jobs are pending)
+PATCH_DEBOUNCE_TIME = 0.5
+#: Time in seconds after which the lock for flushing patches expires
+PATCH_LOCK_TIMEOUT = 300
+#: Maximum time in seconds a background job waits for another job
+#: to finish flushing the patches of a dataset
+PATCH_LOCK_WAIT = 120
+#: Redis key prefix for buffered resource patches
+PATCH_REDIS_PREFIX = "ckanext-dcor_schemas:resource-patches"
+#: Redis key prefix for resource patches that could not be written
+#: (kept for seven days for inspection, not retried)
+PATCH_FAILED_REDIS_PREFIX = "ckanext-dcor_schemas:resource-patches-failed"
+#: Redis key prefix for resources with enqueued dataset-level jobs
+BATCH_REDIS_PREFIX = "ckanext-dcor_schemas:batch-enqueued"
+
+#: Datasets for which resource patches are currently deferred
+_deferred_patch_datasets = set()
+
+#: Minimum time in seconds between progress updates in the job meta
+PROGRESS_INTERVAL = 5
+
+#: Metadata-only predicates telling whether a job would change a resource
+#: (see :func:`job_needs_run` and :func:`needs_run`)
+JOB_NEEDS_RUN = {}
+
 
 def admin_background_context():
     return {"ignore_auth": True,
@@ -22,6 +58,33 @@ def admin_background_context():
             }
 
 
+def job_needs_run(job_name):
+    """Decorator for registering the `needs_run` predicate of a job
+
+    The predicate is called with the resource dictionary and the
+    (optional) dataset dictionary. It must not access the S3 object
+    storage and it must return True if the job would (probably) change
+    the resource metadata.
+    """
+    def decorator(func):
+        JOB_NEEDS_RUN[job_name] = func
+        return func
+    return decorator
+
+
+def needs_run(job_name, resource, dataset=None):
+    """Return whether a background job would change a resource
+
+    Only the resource (and dataset) metadata are taken into account,
+    i.e. no data are downloaded from S3. Jobs without a registered
+    predicate are assumed to always do something.
+    """
+    predicate = JOB_NEEDS_RUN.get(job_name)
+    if predicate is None:
+        return True
+    return predicate(resource, dataset or {})
+
+
 def get_base_metadata(resource):
     res_dict_base = {}
     suffix = "." + resource["name"].rsplit(".", 1)[-1]
@@ -41,17 +104,433 @@ def get_base_metadata(resource):
     return res_dict_base
 
 
+def get_dc_config_metadata(ds):
+    """Return all JSON-compliant DC config metadata of a dclab dataset
+
+    The keys of the returned dictionary are in the "dc:sec:key" format.
+    """
+    res_dict = {}
+    for sec in dclab.dfn.CFG_METADATA:
+        if sec in ds.config:
+            for key in dclab.dfn.config_keys[sec]:
+                if key in ds.config[sec]:
+                    dckey = f"dc:{sec}:{key}"
+                    value = ds.config[sec][key]
+                    # Only allow values that are JSON compliant.
+                    # This is necessary, because CKAN stores and
+                    # loads these values as plain JSON.
+                    try:
+                        json.dumps(value,
+                                   allow_nan=False,
+                                   ensure_ascii=False)
+                    except ValueError:
+                        pass
+                    else:
+                        res_dict[dckey] = value
+    return res_dict
+
+
+def get_dc_metadata_pending(resource, etag=None):
+    """Return which DC metadata of a resource are missing or outdated
+
+    Parameters
+    ----------
+    resource: dict
+        resource dictionary
+    etag: str
+        ETag of the resource on S3; If not given, the ETag stored in
+        the resource metadata is used (no S3 access).
+
+    Returns
+    -------
+    set_format: bool
+        whether the "format" must be set
+    set_config: bool
+        whether the "dc:sec:key" metadata must be set
+    set_sanity: bool
+        whether the sanity-check verdict must be (re)computed
+    """
+    mimetype = get_base_metadata(resource).get("mimetype",
+                                               resource.get("mimetype"))
+    if mimetype not in DC_MIME_TYPES:
+        return False, False, False
+    if etag is None:
+        etag = str(resource.get("etag", ""))
+        if len(etag.split("-")[0]) != 32:
+            etag = None
+    # (if format is already something like RT-FDC then we don't do this)
+    set_format = resource.get("format") in [mimetype, None, ""]
+    set_config = resource.get("dc:setup:channel width", None) is None
+    # The sanity-check verdict is tied to the ETag of the S3 object.
+    set_sanity = (resource.get("dc_sanity_passed", None) is None
+                  or etag is None
+                  or resource.get("dc_sanity_etag") != etag)
+    return set_format, set_config, set_sanity
+
+
+def get_job_progress_callback(resource_id):
+    """Return a callback that stores the progress in the current job meta
+
+    The progress is stored as `job.meta["progress"]`, a dictionary
+    with the keys "resource_id", "done", and "total". Returns None if
+    not called from within an RQ job.
+    """
+    job = rq.get_current_job()
+    if job is None:
+        return None
+    time_last = [0]
+
+    def callback(done, total):
+        now = time.monotonic()
+        if now - time_last[0] > PROGRESS_INTERVAL or done == total:
+            time_last[0] = now
+            job.meta["progress"] = {"resource_id": resource_id,
+                                    "done": done,
+                                    "total": total,
+                                    }
+            job.save_meta()
+
+    return callback
+
+
+def get_resource_etag(resource):
+    """Return the ETag of a resource (from metadata or from S3)
+
+    Returns None if the ETag is not stored in the resource metadata
+    and the resource does not exist on S3.
+    """
+    etag = str(resource.get("etag", ""))
+    if len(etag.split("-")[0]) != 32:
+        # The ETag is not stored in the resource metadata (yet).
+        etag = s3_meta.get_artifact_meta(resource["id"])["etag"]
+    return etag
+
+
+@contextlib.contextmanager
+def deferred_resource_patches(package_id):
+    """Context manager for buffering resource patches of a dataset
+
+    Within this context, :func:`patch_resource_noauth` only buffers the
+    patches for the dataset `package_id`. All patches are written with
+    a single call to `package_revise` when the context is left.
+    """
+    _deferred_patch_datasets.add(package_id)
+    try:
+        yield
+    finally:
+        _deferred_patch_datasets.discard(package_id)
+        try:
+            flush_resource_patches(package_id, debounce=0)
+        except Exception:
+            # Do not hide an exception raised within the context.
+            logger.error(f"Could not flush resource patches of "
+                         f"{package_id}:\n{traceback.format_exc()}")
+
+
+def enqueue_dataset_jobs(package_id, resource_ids):
+    """Enqueue all background jobs for multiple resources of a dataset
+
+    In contrast to `RQJob.enqueue_all_jobs`, which enqueues every job
+    for every resource, only one job per job method (stage) is enqueued
+    here. Each of these jobs processes all resources in one worker
+    invocation (see :func:`run_dataset_job_stage`). The dependencies
+    between the stages are the same as for the individual jobs.
+
+    Resources for which jobs have already been enqueued are ignored.
+    """
+    redis_conn = connect_to_redis()
+    rids = []
+    for rid in resource_ids:
+        if redis_conn.set(f"{BATCH_REDIS_PREFIX}:{rid}", package_id,
+                          nx=True, ex=86400):
+            rids.append(rid)
+    if not rids:
+        return
+
+    try:
+        _enqueue_dataset_job_stages(package_id, rids)
+    except BaseException:
+        # Allow enqueueing the jobs again.
+        redis_conn.delete(*[f"{BATCH_REDIS_PREFIX}:{rid}" for rid in rids])
+        raise
+
+
+def _enqueue_dataset_job_stages(package_id, resource_ids, job_names=None):
+    """Enqueue one job per stage for multiple resources of a dataset
+
+    If `job_names` is given, only these stages are enqueued and
+    dependencies on other stages are ignored.
+    """
+    jid = f"{package_id}_batch-{uuid.uuid4().hex[:8]}_"
+    for job in RQJob.get_all_job_methods_in_order(ckanext="dcor_schemas"):
+        if job_names is not None and job.name not in job_names:
+            continue
+        rq_args = {
+            "timeout": job.timeout * len(resource_ids),
+            "at_front": job.at_front,
+            "job_id": jid + job.name,
+        }
+        depends_on = [dep for dep in job.depends_on or []
+                      if job_names is None or dep in job_names]
+        if depends_on:
+            rq_args["depends_on"] = [jid + dep for dep in depends_on]
+        toolkit.enqueue_job(run_dataset_job_stage,
+                            [job.name, package_id, resource_ids],
+                            title=f"{job.title} "
+                                  f"({len(resource_ids)} resources)",
+                            queue=job.queue,
+                            rq_kwargs=rq_args)
+
+
+def _get_dependent_job_names(job_name):
+    """Return the names of all jobs that (indirectly) depend on a job"""
+    dependents = set()
+    # The jobs are sorted such that dependencies come first.
+    for job in RQJob.get_all_job_methods_in_order(ckanext="dcor_schemas"):
+        for dep in job.depends_on or []:
+            if dep == job_name or dep in dependents:
+                dependents.add(job.name)
+                break
+    return dependents
+
+
+def has_dataset_jobs(resource_id):
+    """Whether dataset-level jobs were enqueued for a resource
+
+    See :func:`enqueue_dataset_jobs`.
+    """
+    redis_conn = connect_to_redis()
+    return bool(redis_conn.exists(f"{BATCH_REDIS_PREFIX}:{resource_id}"))
+
+
+def flush_resource_patches(package_id, debounce=None):
+    """Write all buffered resource patches of a dataset to the database
+
+    The patches buffered by :func:`patch_resource_noauth` are written
+    with a single call to `package_revise`. If patches of other
+    background jobs are pending, we wait for `debounce` seconds before
+    doing so, allowing concurrent jobs to add their patches as well.
+    Only one worker flushes the patches of a dataset at a time (Redis
+    lock). When this function returns, all patches buffered before it
+    was called have been processed (either by this or by another
+    worker). A :class:`TimeoutError` is raised if the lock could not
+    be acquired within :const:`PATCH_LOCK_WAIT` seconds; the patches
+    are kept and written by the next flush.
+
+    Patches that could not be written are logged and moved to the
+    Redis list :const:`PATCH_FAILED_REDIS_PREFIX` of the dataset.
+    They are not retried, so they cannot block later patches.
+    """
+    if debounce is None:
+        debounce = PATCH_DEBOUNCE_TIME
+    redis_conn = connect_to_redis()
+    key_patches = f"{PATCH_REDIS_PREFIX}:{package_id}"
+    lock = redis_conn.lock(f"{key_patches}:lock",
+                           timeout=PATCH_LOCK_TIMEOUT,
+                           blocking_timeout=PATCH_LOCK_WAIT)
+    if not lock.acquire():
+        raise TimeoutError(f"Could not acquire lock for flushing resource "
+                           f"patches of {package_id} within "
+                           f"{PATCH_LOCK_WAIT}s")
+    try:
+        count = redis_conn.llen(key_patches)
+        if count:
+            if count > 1 and debounce:
+                # Other jobs are patching this dataset concurrently.
+                time.sleep(debounce)
+            # Take all pending patches at once. Patches appended in the
+            # meantime are flushed by the next call, and if our lock
+            # expires, another worker cannot take the same patches.
+            key_flush = f"{key_patches}:flush:{uuid.uuid4()}"
+            try:
+                redis_conn.rename(key_patches, key_flush)
+            except ResponseError:
+                # The list expired in the meantime.
+                return
+            redis_conn.expire(key_flush, 86400)
+            entries = redis_conn.lrange(key_flush, 0, -1)
+            patches = {}
+            for entry in entries:
+                rid, data_dict = json.loads(entry,
+                                            object_hook=_patch_json_decode)
+                patches.setdefault(rid, {}).update(data_dict)
+            failed = patches
+            try:
+                failed = revise_resources_noauth(package_id, patches)
+            finally:
+                if failed:
+                    key_failed = f"{PATCH_FAILED_REDIS_PREFIX}:{package_id}"
+                    logger.error(f"Discarding patches of {package_id} for "
+                                 f"resources {', '.join(failed)} (kept in "
+                                 f"'{key_failed}')")
+                    redis_conn.rpush(
+                        key_failed,
+                        *[json.dumps([rid, failed[rid]],
+                                     default=_patch_json_encode)
+                          for rid in failed])
+                    redis_conn.expire(key_failed, 7 * 86400)
+                redis_conn.delete(key_flush)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # The lock expired and may now be owned by another worker.
+            logger.warning(f"Lock for flushing resource patches of "
+                           f"{package_id} expired")
+
+
 def patch_resource_noauth(package_id, resource_id, data_dict):
-    """Patch a resource using package_revise"""
+    """Patch a resource using package_revise
+
+    The patch is buffered in Redis and written to the database together
+    with the patches of other background jobs for the same dataset
+    (see :func:`flush_resource_patches`). This avoids calling
+    `package_revise` (which validates and re-indexes the entire dataset)
+    for every single background job.
+    """
+    redis_conn = connect_to_redis()
+    key_patches = f"{PATCH_REDIS_PREFIX}:{package_id}"
+    redis_conn.rpush(key_patches,
+                     json.dumps([resource_id, data_dict],
+                                default=_patch_json_encode))
+    # Do not keep orphaned patches forever in case a worker dies.
+    redis_conn.expire(key_patches, 86400)
+    if package_id not in _deferred_patch_datasets:
+        flush_resource_patches(package_id)
+
+
+def revise_resources_noauth(package_id, patches):
+    """Patch multiple resources of a dataset using package_revise
+
+    Parameters
+    ----------
+    package_id: str
+        dataset ID
+    patches: dict
+        dictionary with resource IDs as keys and the corresponding
+        resource patch dictionaries as values
+
+    Returns
+    -------
+    failed: dict
+        subset of `patches` that could not be written (errors are
+        logged)
+    """
+    # Discard patches for resources that have been removed in the
+    # meantime, otherwise they would be retried forever.
+    for rid in list(patches):
+        res = model.Resource.get(rid)
+        if (res is None or res.state != model.State.ACTIVE
+                or res.package_id != package_id):
+            logger.warning(f"Discarding patch for removed resource {rid}")
+            patches.pop(rid)
+    if not patches:
+        return {}
     package_revise = logic.get_action("package_revise")
-    revise_dict = {"match": {"id": package_id},
-                   "update__resources__{}".format(resource_id): data_dict}
-    package_revise(context=admin_background_context(), data_dict=revise_dict)
+    revise_dict = {"match": {"id": package_id}}
+    for rid in patches:
+        revise_dict[f"update__resources__{rid}"] = patches[rid]
+    try:
+        package_revise(context=admin_background_context(),
+                       data_dict=revise_dict)
+    except Exception:
+        logger.error(f"Could not patch resources of {package_id} at "
+                     f"once:\n{traceback.format_exc()}")
+    else:
+        return {}
+
+    # A single invalid patch must not discard all other patches.
+    failed = {}
+    if len(patches) > 1:
+        logger.info(f"Patching resources of {package_id} one at a time")
+        for rid in patches:
+            try:
+                package_revise(
+                    context=admin_background_context(),
+                    data_dict={"match": {"id": package_id},
+                               f"update__resources__{rid}": patches[rid]})
+            except Exception as e:
+                logger.error(f"Could not patch resource {rid}: {e}")
+                failed[rid] = patches[rid]
+    else:
+        failed.update(patches)
+    return failed
+
+
+def run_dataset_job_stage(job_name, package_id, resource_ids):
+    """Run one background job method for multiple resources of a dataset
+
+    The dataset is fetched only once (and passed to the job methods)
+    and all resource patches are written with one call to
+    `package_revise`. Errors for individual resources are logged and
+    do not prevent processing the other resources. Afterwards, an
+    exception is raised if any resource failed. Since RQ does not run
+    the stages that depend on a failed job, these stages are enqueued
+    again for the resources that succeeded, and the batch markers of
+    the failed resources are cleared so their jobs can be enqueued
+    again.
+    """
+    for job in RQJob.get_all_job_methods_in_order(ckanext="dcor_schemas"):
+        if job.name == job_name:
+            break
+    else:
+        raise KeyError(f"Unknown background job '{job_name}'")
+
+    ds_dict = logic.get_action("package_show")(
+        admin_background_context(),
+        {"id": package_id})
+    res_dicts = {res["id"]: res for res in ds_dict["resources"]}
+
+    failed = []
+    with deferred_resource_patches(package_id):
+        for rid in resource_ids:
+            if rid not in res_dicts:
+                logger.warning(f"Resource {rid} not in dataset {package_id}")
+                continue
+            try:
+                job.method(res_dicts[rid], dataset=ds_dict)
+            except Exception:
+                logger.error(f"{job.title} failed for resource {rid}:\n"
+                             f"{traceback.format_exc()}")
+                failed.append(rid)
+
+    if failed:
+        redis_conn = connect_to_redis()
+        redis_conn.delete(*[f"{BATCH_REDIS_PREFIX}:{rid}" for rid in failed])
+        succeeded = [rid for rid in resource_ids
+                     if rid in res_dicts and rid not in failed]
+        dependents = _get_dependent_job_names(job.name)
+        if succeeded and dependents:
+            _enqueue_dataset_job_stages(package_id, succeeded, dependents)
+        raise RuntimeError(f"{job.title} failed for {len(failed)} of "
+                           f"{len(resource_ids)} resources of dataset "
+                           f"{package_id}: {', '.join(failed)}")
+
+
+def _patch_json_decode(obj):
+    if "__datetime__" in obj:
+        return datetime.datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def _patch_json_encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {"__datetime__": obj.isoformat()}
+    raise TypeError(f"Cannot serialize {obj} for resource patch")
+
+
+@job_needs_run("job_set_resource_metadata_base")
+def needs_run_resource_metadata_base(resource, dataset):
+    res_dict_base = get_base_metadata(resource)
+    for key in res_dict_base:
+        if res_dict_base[key] != resource.get(key):
+            return True
+    return False
 
 
 @rqjob_register(ckanext="dcor_schemas",
                 queue="dcor-short")
-def job_set_resource_metadata_base(resource):
+def job_set_resource_metadata_base(resource, dataset=None):
     """Set basic resource metadata
 
     `package_revise` calls `after_dataset_update` which calls
@@ -70,30 +549,39 @@ def job_set_resource_metadata_base(resource):
     When a resource is migrated to a different instance, then its "url"
     metadata field must change. This can be taken care of by simply
     running this background job manually via the CLI.
+
+    If `dataset` (the current dataset dictionary, e.g. from
+    :func:`run_dataset_job_stage`) is given, `resource` is taken
+    from the database and no additional lookup is performed.
     """
     res_dict_base = get_base_metadata(resource)
-    # Do not compare against `resource`, because this dictionary might
-    # not be the one that we have in the database.
-    resource_show = logic.get_action("resource_show")
-    changes_required = False
+    if dataset is not None:
+        changes_required = needs_run_resource_metadata_base(resource, dataset)
+    else:
+        # Do not compare against `resource`, because this dictionary might
+        # not be the one that we have in the database.
+        resource_show = logic.get_action("resource_show")
+        changes_required = False
 
-    # be patient when showing the resource for the first time
-    for ii in range(5):
-        try:
-            res_dict_act = resource_show(context=admin_background_context(),
-                                         data_dict={"id": resource['id']})
-        except BaseException:
-            logger.error(f"Could not fetch resource dict for {resource['id']}")
-            time.sleep(0.5)
+        # be patient when showing the resource for the first time
+        for ii in range(5):
+            try:
+                res_dict_act = resource_show(
+                    context=admin_background_context(),
+                    data_dict={"id": resource['id']})
+            except BaseException:
+                logger.error(
+                    f"Could not fetch resource dict for {resource['id']}")
+                time.sleep(0.5)
+            else:
+                for key in res_dict_base:
+                    if res_dict_base[key] != res_dict_act.get(key):
+                        changes_required = True
+                        break
+                break
         else:
-            for key in res_dict_base:
-                if res_dict_base[key] != res_dict_act.get(key):
-                    changes_required = True
-                    break
-            break
-    else:
-        # Fall-back to applying the changes anyway
-        changes_required = True
+            # Fall-back to applying the changes anyway
+            changes_required = True
 
     if changes_required:
         res_dict_base["last_modified"] = datetime.datetime.now(
@@ -107,47 +595,13 @@ def job_set_resource_metadata_base(resource):
         return False
 
 
-@rqjob_register(ckanext="dcor_schemas",
-                queue="dcor-normal",
-                timeout=500,
-                depends_on=["job_set_s3_resource_metadata",
-                            "job_set_resource_metadata_base",
-                            "job_set_dc_format",
-                            ])
-def job_set_dc_config(resource):
-    """Store all DC config metadata"""
-    resource.update(get_base_metadata(resource))
-    if (resource.get("mimetype") in DC_MIME_TYPES
-            and resource.get("dc:setup:channel width", None) is None):
-        rid = resource["id"]
-        wait_for_resource(rid)
-        res_dict = {}
-        with get_dc_instance(rid) as ds:
-            for sec in dclab.dfn.CFG_METADATA:
-                if sec in ds.config:
-                    for key in dclab.dfn.config_keys[sec]:
-                        if key in ds.config[sec]:
-                            dckey = f"dc:{sec}:{key}"
-                            value = ds.config[sec][key]
-                            # Only allow values that are JSON compliant.
-                            # This is necessary, because CKAN stores and
-                            # loads these values as plain JSON.
-                            try:
-                                json.dumps(value,
-                                           allow_nan=False,
-                                           ensure_ascii=False)
-                            except ValueError:
-                                pass
-                            else:
-                                res_dict[dckey] = value
-        res_dict["last_modified"] = datetime.datetime.now(
-            datetime.timezone.utc)
-        patch_resource_noauth(
-            package_id=resource["package_id"],
-            resource_id=rid,
-            data_dict=res_dict)
-        return True
-    return False
+@job_needs_run("job_set_etag")
+def needs_run_etag(resource, dataset):
+    etag = str(resource.get("etag", ""))
+    # Example ETags:
+    # - "69725a2f8ea27a47401960990377188b": MD5 sum of a file
+    # - "81a89c74b50282fc02e4faa7b654a05a-4": multipart upload
+    return len(etag.split("-")[0]) != 32
 
 
 @rqjob_register(ckanext="dcor_schemas",
@@ -156,22 +610,15 @@ def job_set_dc_config(resource):
                 at_front=True,
                 depends_on=["job_set_s3_resource_metadata"],
                 )
-def job_set_etag(resource):
+def job_set_etag(resource, dataset=None):
     """Set the resource ETag extracted from S3"""
-    etag = str(resource.get("etag", ""))
     rid = resource["id"]
-    # Example ETags:
-    # - "69725a2f8ea27a47401960990377188b": MD5 sum of a file
-    # - "81a89c74b50282fc02e4faa7b654a05a-4": multipart upload
-    if len(etag.split("-")[0]) != 32:  # only compute if necessary
+    if needs_run_etag(resource, {}):  # only compute if necessary
         wait_for_resource(rid)
         # The file must exist on S3 object storage
-        bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
-            resource_id=rid, artifact="resource")
-        s3_client, _, _ = s3.get_s3()
-        meta = s3_client.head_object(Bucket=bucket_name, Key=object_name)
-        if "ETag" in meta:
-            etag = meta["ETag"].strip("'").strip('"')
+        meta = s3_meta.get_artifact_meta(rid)
+        if meta["etag"]:
+            etag = meta["etag"]
             res_dict = {"etag": etag,
                         "last_modified": datetime.datetime.now(
                             datetime.timezone.utc),
@@ -184,49 +631,97 @@ def job_set_etag(resource):
     return False
 
 
+@job_needs_run("job_set_dc_metadata")
+def needs_run_dc_metadata(resource, dataset):
+    return any(get_dc_metadata_pending(resource))
+
+
 @rqjob_register(ckanext="dcor_schemas",
-                queue="dcor-short",
+                queue="dcor-normal",
                 timeout=500,
                 depends_on=["job_set_s3_resource_metadata",
                             "job_set_resource_metadata_base",
                             "job_set_etag",
                             ])
-def job_set_dc_format(resource):
-    """Writes the correct format to the resource metadata"""
+def job_set_dc_metadata(resource, dataset=None):
+    """Inspect DC data and store format, config, and sanity metadata
+
+    The DC data are opened only once and the following metadata are
+    written to the resource with a single call to `package_revise`:
+
+    - "format": "RT-FDC" if the data contain fluorescence data,
+      "RT-DC" otherwise
+    - "dc:sec:key": all DC config metadata
+    - "dc_sanity_passed": whether the dclab sanity check passed
+      (used by `validate.dataset_state` when activating a dataset)
+    - "dc_sanity_etag": the ETag of the S3 object for which the
+      sanity check was performed
+    """
+    resource.update(get_base_metadata(resource))
     mimetype = resource.get("mimetype")
+    if mimetype not in DC_MIME_TYPES:
+        return False
+
     rformat = resource.get("format")
-    if mimetype in DC_MIME_TYPES and rformat in [mimetype, None, ""]:
-        rid = resource["id"]
-        # (if format is already something like RT-FDC then we don't do this)
-        wait_for_resource(rid)
-        ds = get_dc_instance(rid)
-        with ds, dclab.IntegrityChecker(ds) as ic:
-            if ic.has_fluorescence:
-                fmt = "RT-FDC"
-            else:
-                fmt = "RT-DC"
-        if rformat != fmt:  # only update if necessary
-            res_dict = {"format": fmt,
-                        "last_modified": datetime.datetime.now(
-                            datetime.timezone.utc),
-                        }
-            patch_resource_noauth(
-                package_id=resource["package_id"],
-                resource_id=rid,
-                data_dict=res_dict)
-            return True
+    if resource.get("dc_sanity_passed", None) is None:
+        etag = None
+    else:
+        # We have to check whether the verdict belongs to the S3 object.
+        etag = get_resource_etag(resource)
+    set_format, set_config, set_sanity = get_dc_metadata_pending(
+        resource, etag=etag)
+    if not (set_format or set_config or set_sanity):
+        return False
+
+    rid = resource["id"]
+    wait_for_resource(rid)
+    etag = get_resource_etag(resource)
+    if etag is None:
+        # There is no S3 object, so there is nothing to inspect and no
+        # ETag to which a sanity-check verdict could be tied.
+        logger.warning(f"Not inspecting resource {rid} (no S3 object)")
+        return False
+    res_dict = {}
+    ds = get_dc_instance(rid)
+    with ds, dclab.IntegrityChecker(ds) as ic:
+        if set_format:
+            fmt = "RT-FDC" if ic.has_fluorescence else "RT-DC"
+            if rformat != fmt:  # only update if necessary
+                res_dict["format"] = fmt
+        if set_config:
+            res_dict.update(get_dc_config_metadata(ds))
+        if set_sanity:
+            res_dict["dc_sanity_passed"] = not ic.sanity_check()
+            res_dict["dc_sanity_etag"] = etag
+
+    if res_dict:
+        res_dict["last_modified"] = datetime.datetime.now(
+            datetime.timezone.utc)
+        patch_resource_noauth(
+            package_id=resource["package_id"],
+            resource_id=rid,
+            data_dict=res_dict)
+        return True
     return False
 
 
+@job_needs_run("job_set_s3_resource_metadata")
+def needs_run_s3_resource_metadata(resource, dataset):
+    return "s3_available" not in resource or "s3_url" not in resource
+
+
 @rqjob_register(ckanext="dcor_schemas",
                 queue="dcor-short",
                 timeout=500,
                 )
-def job_set_s3_resource_metadata(resource):
+def job_set_s3_resource_metadata(resource, dataset=None):
     """Set S3-related resource metadata"""
     rid = resource["id"]
-    if (("s3_available" not in resource or "s3_url" not in resource)
-            and s3cc.artifact_exists(resource_id=rid, artifact="resource")):
+    if not needs_run_s3_resource_metadata(resource, {}):
+        return
+    # HEAD request shared with the other jobs (existence, size, ETag)
+    meta = s3_meta.get_artifact_meta(rid)
+    if meta["exists"]:
         s3_url = s3cc.get_s3_url_for_artifact(resource_id=rid)
         res_new_dict = {"s3_available": True,
                         "s3_url": s3_url,
@@ -236,7 +731,6 @@ def job_set_s3_resource_metadata(resource):
         if not resource.get("size"):
             # Resource has been uploaded via S3 and CKAN did not pick up
             # the size.
-            meta = s3cc.get_s3_attributes_for_artifact(rid)
             res_new_dict["size"] = meta["size"]
         if not resource.get("url_type"):
             # Resource has been uploaded via S3 and CKAN did not set the
@@ -249,19 +743,27 @@ def job_set_s3_resource_metadata(resource):
             data_dict=res_new_dict)
 
 
+@job_needs_run("job_set_s3_resource_public_tag")
+def needs_run_s3_resource_public_tag(resource, dataset):
+    # The tags of the S3 object are not known without accessing S3,
+    # so we assume that all resources of public datasets need tagging.
+    private = dataset.get("private")
+    return private is not None and not private
+
+
 @rqjob_register(ckanext="dcor_schemas",
                 queue="dcor-short",
                 timeout=300,
                 )
-def job_set_s3_resource_public_tag(resource):
+def job_set_s3_resource_public_tag(resource, dataset=None):
     """Set the public=True tag to an S3 object if the dataset is public"""
     # Determine whether the resource is public
-    ds_dict = logic.get_action("package_show")(
-        admin_background_context(),
-        {"id": resource["package_id"]})
-    private = ds_dict.get("private")
-    if private is not None and not private:
-        s3cc.make_resource_public(
+    if dataset is None:
+        dataset = logic.get_action("package_show")(
+            admin_background_context(),
+            {"id": resource["package_id"]})
+    if needs_run_s3_resource_public_tag(resource, dataset):
+        s3_meta.make_resource_public(
             resource_id=resource["id"],
             # The resource might not be there, because it was uploaded
             # using the API and not to S3.
@@ -269,19 +771,33 @@ def job_set_s3_resource_public_tag(resource):
         )
 
 
+@job_needs_run("job_set_sha256")
+def needs_run_sha256(resource, dataset):
+    sha = str(resource.get("sha256", ""))  # can be bool sometimes
+    return len(sha) != 64
+
+
 @rqjob_register(ckanext="dcor_schemas",
                 queue="dcor-long",
                 timeout=3600,
                 depends_on=["job_set_s3_resource_metadata"],
                 )
-def job_set_sha256(resource):
+def job_set_sha256(resource, dataset=None):
     """Computes the sha256 hash and writes it to the resource metadata"""
-    sha = str(resource.get("sha256", ""))  # can be bool sometimes
     rid = resource["id"]
-    if len(sha) != 64:  # only compute if necessary
+    if needs_run_sha256(resource, {}):  # only compute if necessary
         wait_for_resource(rid)
         # The file must exist on S3 object storage
-        rhash = s3cc.compute_checksum(rid)
+        bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+            resource_id=rid, artifact="resource")
+        # If S3 verified the SHA256 sum during the upload, we do not
+        # have to download the object.
+        rhash = checksum.get_verified_checksum(bucket_name, object_name)
+        if rhash is None:
+            rhash = checksum.compute_checksum(
+                bucket_name=bucket_name,
+                object_name=object_name,
+                progress_callback=get_job_progress_callback(rid))
         res_dict = {"sha256": rhash,
                     "last_modified": datetime.datetime.now(
                         datetime.timezone.utc),
@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+
+from boto3.s3.transfer import TransferConfig
+import botocore.exceptions
+from dcor_shared import s3, s3cc
+
+from . import checksum, s3_meta
+
+
+#: Default number of concurrent S3 copy operations
+COPY_JOBS = 4
+#: Largest object size in bytes for which S3 supports `CopyObject`
+COPY_OBJECT_MAX_SIZE = 5 * 1024**3
+#: Artifacts stored on S3 for each resource
+ARTIFACTS = ["condensed", "preview", "resource"]
+
+
+def get_copy_transfer_config(bucket_name, object_name, etag, size):
+    """Return a transfer config that reproduces the ETag of an S3 object
+
+    The ETag of an object uploaded with multipart upload is computed
+    from the MD5 sums of its parts ("<md5 of md5s>-<number of parts>").
+    To obtain the same ETag for a copy, the copy must be done with the
+    same part size. The part size is determined from the size of the
+    first part of the source object.
+    """
+    if "-" not in etag:
+        # Single-part object; `CopyObject` preserves the ETag.
+        return TransferConfig(multipart_threshold=COPY_OBJECT_MAX_SIZE + 1,
+                              multipart_chunksize=COPY_OBJECT_MAX_SIZE)
+    s3_client, _, _ = s3.get_s3()
+    part = s3_client.head_object(Bucket=bucket_name,
+                                 Key=object_name,
+                                 PartNumber=1)
+    part_size = min(part["ContentLength"], size)
+    return TransferConfig(multipart_threshold=part_size,
+                          multipart_chunksize=part_size)
+
+
+def copy_object_verified(bucket_old, bucket_new, object_name, sha256=None,
+                         public=False):
+    """Copy an S3 object to a different bucket and verify the copy
+
+    The object is copied on the server side. The copy is verified by
+    comparing size and ETag of the objects. Only if the ETags differ
+    (e.g. if the source was uploaded with an unusual part layout),
+    the SHA256 sum of the copy is computed and compared to `sha256`
+    (or the SHA256 sum of the source object if `sha256` is not given).
+
+    Returns
+    -------
+    size: int or None
+        size of the copied object in bytes or None if the source
+        object does not exist
+    """
+    s3_client, _, _ = s3.get_s3()
+    try:
+        meta_old = s3_client.head_object(Bucket=bucket_old, Key=object_name)
+    except botocore.exceptions.ClientError:
+        return None
+    etag_old = meta_old["ETag"].strip("'").strip('"')
+    size = meta_old["ContentLength"]
+    s3_client.copy({"Bucket": bucket_old, "Key": object_name},
+                   bucket_new,
+                   object_name,
+                   Config=get_copy_transfer_config(
+                       bucket_old, object_name, etag_old, size))
+
+    meta_new = s3_client.head_object(Bucket=bucket_new, Key=object_name)
+    etag_new = meta_new["ETag"].strip("'").strip('"')
+    if meta_new["ContentLength"] != size:
+        raise ValueError(f"Size mismatch for {bucket_new}:{object_name} "
+                         f"({meta_new['ContentLength']} != {size})")
+    if etag_new != etag_old:
+        sha_new = checksum.compute_checksum(bucket_new, object_name,
+                                            size=size)
+        if sha256 is None or len(str(sha256)) != 64:
+            sha256 = checksum.compute_checksum(bucket_old, object_name,
+                                               size=size)
+        if sha_new != sha256:
+            raise ValueError(f"Checksum mismatch for {bucket_new}:"
+                             f"{object_name} ({sha_new} != {sha256})")
+
+    if public:
+        s3.make_object_public(bucket_name=bucket_new,
+                              object_name=object_name,
+                              missing_ok=False)
+    s3_meta.invalidate(bucket_new, object_name)
+    return size
+
+
+def get_dataset_copy_tasks(ds_dict, circle_old, circle_new):
+    """Return the list of S3 copy tasks for moving a dataset
+
+    Each task is a dictionary with the keys "dataset_id",
+    "resource_id", "artifact", "bucket_old", "bucket_new",
+    "object_name", "sha256", and "public" (see :func:`copy_artifacts`).
+    """
+    public = not ds_dict["private"]
+    tasks = []
+    for rs_dict in ds_dict["resources"]:
+        rid = rs_dict["id"]
+        for art in ARTIFACTS:
+            bucket_old, obj = s3cc.get_s3_bucket_object_for_artifact(rid, art)
+            bucket_new = bucket_old.replace(circle_old, circle_new)
+            if bucket_old == bucket_new:
+                raise ValueError(f"Bucket name {bucket_old} does not "
+                                 f"contain the circle ID {circle_old}")
+            tasks.append({
+                "dataset_id": ds_dict["id"],
+                "resource_id": rid,
+                "artifact": art,
+                "bucket_old": bucket_old,
+                "bucket_new": bucket_new,
+                "object_name": obj,
+                "sha256": rs_dict.get("sha256") if art == "resource" else None,
+                "public": public,
+            })
+    return tasks
+
+
+def copy_artifacts(tasks, num_jobs=COPY_JOBS, callback=None):
+    """Perform S3 copy tasks concurrently
+
+    Parameters
+    ----------
+    tasks: list of dict
+        copy tasks (see :func:`get_dataset_copy_tasks`); The tasks
+        may belong to different datasets.
+    num_jobs: int
+        number of concurrent copy operations
+    callback: callable
+        called with the task dictionary and the size of the copied
+        object for each copied artifact
+
+    Returns
+    -------
+    copied: list of dict
+        the tasks for which an object was copied (source objects
+        that do not exist are ignored)
+    """
+    for bucket_new in sorted(set(t["bucket_new"] for t in tasks)):
+        s3.require_bucket(bucket_new)
+
+    copied = []
+    with ThreadPoolExecutor(max_workers=max(1, num_jobs)) as pool:
+        futures = {}
+        for task in tasks:
+            fut = pool.submit(copy_object_verified,
+                              bucket_old=task["bucket_old"],
+                              bucket_new=task["bucket_new"],
+                              object_name=task["object_name"],
+                              sha256=task["sha256"],
+                              public=task["public"])
+            futures[fut] = task
+        for fut in as_completed(futures):
+            task = futures[fut]
+            size = fut.result()
+            if size is None:
+                # artifact does not exist (e.g. no condensed file)
+                continue
+            copied.append(task)
+            if callback is not None:
+                callback(task, size)
+    return copied
+
+
+def copy_dataset_artifacts(ds_dict, circle_old, circle_new,
+                           num_jobs=COPY_JOBS, callback=None):
+    """Copy all S3 artifacts of a dataset to the buckets of a new circle
+
+    Parameters
+    ----------
+    ds_dict: dict
+        dataset dictionary
+    circle_old: str
+        ID of the circle the dataset currently belongs to
+    circle_new: str
+        ID of the new circle
+    num_jobs: int
+        number of concurrent copy operations
+    callback: callable
+        called with the resource ID, the artifact name, and the size of
+        the copied object for each copied artifact
+
+    Returns
+    -------
+    copied: list
+        list of `[bucket_name, object_name]` of the copied objects in
+        the old buckets
+    """
+    tasks = get_dataset_copy_tasks(ds_dict, circle_old, circle_new)
+    copied = copy_artifacts(
+        tasks,
+        num_jobs=num_jobs,
+        callback=None if callback is None else (
+            lambda task, size: callback(task["resource_id"],
+                                        task["artifact"],
+                                        size)))
+    return [[t["bucket_old"], t["object_name"]] for t in copied]
+
+
+def delete_objects(objects):
+    """Delete S3 objects given as a list of `[bucket_name, object_name]`
+
+    The objects are deleted with one `DeleteObjects` request per bucket
+    and batch of 1000 objects. Objects (and buckets) that do not exist
+    are ignored.
+    """
+    s3_client, _, _ = s3.get_s3()
+    buckets = {}
+    for bucket_name, object_name in objects:
+        buckets.setdefault(bucket_name, []).append(object_name)
+    for bucket_name, keys in buckets.items():
+        for ii in range(0, len(keys), 1000):
+            try:
+                resp = s3_client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={"Objects": [{"Key": k}
+                                        for k in keys[ii:ii + 1000]],
+                            "Quiet": True})
+            except s3_client.exceptions.NoSuchBucket:
+                # nothing to delete
+                break
+            if resp.get("Errors"):
+                raise ValueError(f"Could not delete objects in {bucket_name}: "
+                                 f"{resp['Errors']}")
+            for key in keys[ii:ii + 1000]:
+                s3_meta.invalidate(bucket_name, key)
+
+
+def append_journal(path, entry):
+    """Append an entry to a move journal (JSON lines file)
+
+    The file is synced to disk, so that the journal reflects the
+    state of a migration even if the process is killed.
+    """
+    with open(path, "a") as fd:
+        fd.write(json.dumps(entry) + "\n")
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def read_journal(path):
+    """Return the last journal entry for each dataset in a move journal
+
+    The steps in a journal are (in that order):
+
+    - "copied": the S3 objects were copied to the new circle; the entry
+      contains the keys "circle_old", "circle_new" and "objects" (list
+      of `[bucket_name, object_name]` in the old circle)
+    - "db_updated": the dataset was moved to the new circle in the
+      database
+    - "deleted": the S3 objects in the old circle were deleted
+    - "rolled_back": the copied S3 objects in the new circle were
+      deleted, the dataset is still in the old circle
+    """
+    state = {}
+    if os.path.exists(path):
+        with open(path) as fd:
+            for line in fd:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # incomplete line written during a crash
+                    continue
+                ds_id = entry["dataset"]
+                if entry["step"] == "copied":
+                    state[ds_id] = entry
+                else:
+                    state[ds_id] = dict(state.get(ds_id, {}), **entry)
+    return state
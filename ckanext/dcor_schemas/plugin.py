@@ -6,7 +6,7 @@ import sys
 import ckan.lib.datapreview as datapreview
 from ckan.lib.plugins import DefaultPermissionLabels
 import ckan.lib.signals
-from ckan import authz, config, common, logic, model
+from ckan import authz, config, common, model
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
@@ -48,6 +48,16 @@ if "manage_group" in authz.ROLE_PERMISSIONS["member"]:
     authz.ROLE_PERMISSIONS["member"].remove("manage_group")
 
 
+def copy_schema(schema):
+    """Copy a schema (dictionaries and lists), but not the validators"""
+    if isinstance(schema, dict):
+        return {key: copy_schema(value) for key, value in schema.items()}
+    elif isinstance(schema, list):
+        return list(schema)
+    else:
+        return schema
+
+
 class DCORDatasetFormPlugin(plugins.SingletonPlugin,
                             toolkit.DefaultDatasetForm,
                             DefaultPermissionLabels):
@@ -65,6 +75,11 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
     plugins.implements(plugins.ITemplateHelpers, inherit=True)
     plugins.implements(plugins.IValidators, inherit=True)
 
+    def __init__(self, *args, **kwargs):
+        super(DCORDatasetFormPlugin, self).__init__(*args, **kwargs)
+        #: cached package schemas (see `_get_package_schema`)
+        self._package_schemas = {}
+
     # IActions
     def get_actions(self):
         return {
@@ -161,6 +176,13 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
             "resource schema"
         )
 
+        declaration.declare_int(
+            schema_group.json_resource_schema_reload_interval, 0
+        ).set_description(
+            "interval in seconds for checking the .json files in "
+            "`json_resource_schema_dir` for changes (0 disables reloading)"
+        )
+
         declaration.declare_bool(
             schema_group.notify_user_create, True).set_description(
             "notify the maintainer when a new user is created"
@@ -234,6 +256,14 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
             ],
         })
         schema['resources'].update({
+            # Result of the dclab sanity check (set in a background job)
+            'dc_sanity_passed': [
+                toolkit.get_validator('ignore_missing'),
+                toolkit.get_validator('boolean_validator'),
+            ],
+            'dc_sanity_etag': [
+                toolkit.get_validator('ignore_missing'),
+            ],
             # ETag given by S3 backend
             'etag': [
                 toolkit.get_validator('ignore_missing'),
@@ -265,17 +295,15 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
                 toolkit.get_validator('url_validator'),
             ],
         })
-        # Add dclab configuration parameters
-        for sec in dclab.dfn.CFG_METADATA:
-            for key in dclab.dfn.config_keys[sec]:
-                schema['resources'].update({
-                    'dc:{}:{}'.format(sec, key): [
-                        toolkit.get_validator('ignore_missing'),
-                        toolkit.get_validator(
-                            'dcor_schemas_resource_dc_config'),
-                    ]})
+        # Add dclab configuration parameters (converted for each resource
+        # in one pass by `resource_dc_config_batch`)
+        ignore_missing = toolkit.get_validator('ignore_missing')
+        for dc_key in dcor_validate.DC_CONFIG_FUNCS:
+            schema['resources'][dc_key] = [ignore_missing]
+        schema['resources'].setdefault('__before', []).append(
+            toolkit.get_validator('dcor_schemas_resource_dc_config_batch'))
         # Add supplementary resource schemas
-        for composite_key in rss.get_composite_item_list():
+        for composite_key in rss.get_supplement_index().composite_keys:
             schema['resources'].update({
                 composite_key: [
                     toolkit.get_validator('ignore_missing'),
@@ -285,7 +313,7 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
 
         return schema
 
-    def create_package_schema(self):
+    def _build_create_package_schema(self):
         schema = super(DCORDatasetFormPlugin, self).create_package_schema()
         schema = self._modify_package_schema(schema)
         schema.update({
@@ -297,12 +325,12 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
 
         return schema
 
-    def update_package_schema(self):
+    def _build_update_package_schema(self):
         schema = super(DCORDatasetFormPlugin, self).update_package_schema()
         schema = self._modify_package_schema(schema)
         return schema
 
-    def show_package_schema(self):
+    def _build_show_package_schema(self):
         schema = super(DCORDatasetFormPlugin, self).show_package_schema()
         # remove default fields
         for key in REMOVE_PACKAGE_FIELDS:
@@ -326,6 +354,12 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
             ],
         })
         schema['resources'].update({
+            'dc_sanity_passed': [
+                toolkit.get_validator('ignore_missing'),
+            ],
+            'dc_sanity_etag': [
+                toolkit.get_validator('ignore_missing'),
+            ],
             'etag': [
                 toolkit.get_validator('ignore_missing'),
             ],
@@ -341,13 +375,39 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
                         toolkit.get_validator('ignore_missing'),
                     ]})
         # Add supplementary resource schemas
-        for composite_key in rss.get_composite_item_list():
+        for composite_key in rss.get_supplement_index().composite_keys:
             schema['resources'].update({
                 composite_key: [
                     toolkit.get_validator('ignore_missing'),
                 ]})
         return schema
 
+    def _get_package_schema(self, name, build_schema):
+        """Return a copy of a cached package schema
+
+        CKAN requests the package schemas for every action call. Building
+        them involves hundreds of validator lookups, so they are built
+        only once (for each supplementary resource schema) and copied.
+        """
+        index = rss.get_supplement_index()
+        cached = self._package_schemas.get(name)
+        if cached is None or cached[0] is not index:
+            cached = (index, build_schema())
+            self._package_schemas[name] = cached
+        return copy_schema(cached[1])
+
+    def create_package_schema(self):
+        return self._get_package_schema(
+            "create", self._build_create_package_schema)
+
+    def update_package_schema(self):
+        return self._get_package_schema(
+            "update", self._build_update_package_schema)
+
+    def show_package_schema(self):
+        return self._get_package_schema(
+            "show", self._build_show_package_schema)
+
     def is_fallback(self):
         # Return True to register this plugin as the default handler for
         # package types not handled by any other IDatasetForm plugin.
@@ -373,11 +433,15 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
             # Check for resources that have been added (e.g. using
             # package_revise) during this dataset update.
             # We need the "position" of each resource, so we must fetch
-            # the whole dataset once.
-            ds_dict = logic.get_action('package_show')(
-                context,
-                {'id': data_dict["id"]})
-
+            # the whole dataset once (the cached dataset dictionary from
+            # before the update is outdated).
+            dcor_helpers.invalidate_package_dict(context)
+            ds_dict = dcor_helpers.get_package_dict(context, data_dict["id"])
+
+            # Our own background jobs are enqueued for all new resources
+            # at once below.
+            res_context = dict(context, dcor_schemas_batch_jobs=True)
+            new_resource_ids = []
             for resource in data_dict.get('resources', []):
                 # Do not perform any actions if the resource already
                 # contains the "etag", which means that all background
@@ -386,13 +450,18 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
                     # Update with current
                     for res in ds_dict["resources"]:
                         if resource["id"] == res["id"]:
-                            res.update(resource)
-                            resource = res
+                            # do not modify the cached dataset dictionary
+                            resource = dict(res, **resource)
                             break
                     # Run jobs after resource create
                     for plugin in plugins.PluginImplementations(
                             plugins.IResourceController):
-                        plugin.after_resource_create(context, resource)
+                        plugin.after_resource_create(res_context, resource)
+                    new_resource_ids.append(resource["id"])
+
+            if new_resource_ids:
+                jobs.enqueue_dataset_jobs(package_id=ds_dict["id"],
+                                          resource_ids=new_resource_ids)
 
             private = data_dict.get("private")
             if (private is not None and not private
@@ -465,8 +534,14 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
             # Make sure mimetype etc. are set properly
             resource.update(jobs.get_base_metadata(resource))
 
-            # All jobs are defined via decorators in jobs.py
-            jobs.RQJob.enqueue_all_jobs(resource, ckanext="dcor_schemas")
+            # All jobs are defined via decorators in jobs.py. In
+            # `after_dataset_update`, they are enqueued for all new
+            # resources of a dataset at once. For `resource_create`,
+            # CKAN calls this method again with the original context
+            # after `after_dataset_update`.
+            if not (context.get("dcor_schemas_batch_jobs")
+                    or jobs.has_dataset_jobs(resource["id"])):
+                jobs.RQJob.enqueue_all_jobs(resource, ckanext="dcor_schemas")
 
             # https://github.com/ckan/ckan/issues/7837
             datapreview.add_views_to_resource(context={"ignore_auth": True},
@@ -512,6 +587,8 @@ class DCORDatasetFormPlugin(plugins.SingletonPlugin,
                 dcor_validate.dataset_state,
             "dcor_schemas_resource_dc_config":
                 dcor_validate.resource_dc_config,
+            "dcor_schemas_resource_dc_config_batch":
+                dcor_validate.resource_dc_config_batch,
             "dcor_schemas_resource_dc_supplement":
                 dcor_validate.resource_dc_supplement,
             "dcor_schemas_resource_id":
@@ -1,15 +1,22 @@
+import collections
 from collections import OrderedDict
 import datetime
-import functools
 import json
+import logging
 import numbers
 import os
 import pathlib
+import threading
+import time
+import types
 from pkg_resources import resource_listdir, resource_filename
 
 from ckan.common import config
 
 
+logger = logging.getLogger(__name__)
+
+
 def validate_date(value):
     try:
         datetime.datetime.strptime(value, '%Y-%m-%d')
@@ -50,6 +57,63 @@ VALIDATORS = {
 }
 
 
+#: Item of the supplementary resource schema in a :class:`SupplementIndex`
+SupplementIndexEntry = collections.namedtuple(
+    "SupplementIndexEntry",
+    ["section", "key", "composite_key", "item", "parser", "validator"])
+
+
+class SupplementIndex:
+    def __init__(self, schemas):
+        """Compiled supplementary resource schema
+
+        The schema items are indexed by section and key as well as by
+        their composite key ("sp:section:key"), so that looking up an
+        item (including its parser and validator) is a dictionary access.
+        Use :func:`get_supplement_index` to get the index for the
+        current configuration.
+        """
+        #: schemas as returned by :func:`load_schema_supplements`
+        self.schemas = schemas
+        items = {}
+        composite = {}
+        for sec in schemas:
+            for item in schemas[sec]["items"]:
+                entry = SupplementIndexEntry(
+                    section=sec,
+                    key=item["key"],
+                    composite_key="sp:{}:{}".format(sec, item["key"]),
+                    item=item,
+                    parser=PARSERS[item["type"]],
+                    validator=VALIDATORS[item["type"]],
+                )
+                items[(sec, item["key"])] = entry
+                composite[entry.composite_key] = entry
+        #: maps (section, key) to :class:`SupplementIndexEntry`
+        self.items = types.MappingProxyType(items)
+        #: maps composite keys to :class:`SupplementIndexEntry`
+        self.composite_items = types.MappingProxyType(composite)
+        #: composite keys in schema order
+        self.composite_keys = tuple(composite)
+        #: set of composite keys
+        self.composite_key_set = frozenset(composite)
+
+    def get_entry(self, section, key):
+        """Return the :class:`SupplementIndexEntry` for section and key"""
+        try:
+            return self.items[(section, key)]
+        except KeyError:
+            raise KeyError(
+                "Supplement [{}]: '{}' not found!".format(section, key))
+
+
+#: Compiled supplement index with the schema directory and file signature
+_IndexState = collections.namedtuple(
+    "_IndexState", ["schema_dir", "signature", "time_checked", "index"])
+_index_state = None
+_index_lock = threading.Lock()
+
+
 class SupplementItem(object):
     def __init__(self, section, key, value=None):
         """Represents a supplementary resource schema item
@@ -60,7 +124,8 @@ class SupplementItem(object):
         """
         self.section = section
         self.key = key
-        self._item = get_item(section, key)
+        self._entry = get_supplement_index().get_entry(section, key)
+        self._item = self._entry.item
         self.value = None
         if value is not None:
             self.set_value(value)
@@ -89,12 +154,18 @@ class SupplementItem(object):
         -------
         si: SupplementItem
         """
-        _, section, key = composite_key.strip().split(":")
+        entry = get_supplement_index().composite_items.get(
+            composite_key.strip())
+        if entry is None:
+            # raises the appropriate error
+            _, section, key = composite_key.strip().split(":")
+        else:
+            section, key = entry.section, entry.key
         si = SupplementItem(section=section, key=key)
         if not (composite_value is None
                 or (isinstance(composite_value, str) and
                     len(composite_value) == 0)):
-            si.set_value(PARSERS[si["type"]](composite_value))
+            si.set_value(si._entry.parser(composite_value))
         return si
 
     def to_composite(self):
@@ -102,17 +173,17 @@ class SupplementItem(object):
 
         This implies converting lists to comma-separated strings
         """
-        composite_key = "sp:{}:{}".format(self.section, self.key)
+        composite_key = self._entry.composite_key
         if self.value is None:
             composite_value = None
         else:
-            composite_value = PARSERS[self["type"]](self.value)
+            composite_value = self._entry.parser(self.value)
         return composite_key, composite_value
 
     def set_value(self, value):
         """Set a value of the key, perform checks"""
         # Check for type
-        if not VALIDATORS[self["type"]](value):
+        if not self._entry.validator(value):
             raise ValueError(
                 f"Invalid value for '{self.key}'! You were supposed to pass "
                 f"an object of type '{self['type']}'/{CLASSES[self['type']]} "
@@ -123,12 +194,7 @@ class SupplementItem(object):
 
 def get_composite_item_list():
     """Return the composite item keys list (sp:section:key)"""
-    schemas = load_schema_supplements()
-    cil = []
-    for sec in schemas:
-        for item in schemas[sec]["items"]:
-            cil.append("sp:{}:{}".format(sec, item["key"]))
-    return cil
+    return list(get_supplement_index().composite_keys)
 
 
 def get_composite_section_item_list():
@@ -165,15 +231,81 @@ def get_composite_section_item_list():
 
 def get_item(section, key):
     """Return the schema dictionary item for a section-key pair"""
-    schemas = load_schema_supplements()
-    for item in schemas[section]["items"]:
-        if item["key"] == key:
-            return item
+    return get_supplement_index().get_entry(section, key).item
+
+
+def get_supplement_index():
+    """Return the :class:`SupplementIndex` for the current configuration
+
+    The index is compiled only once. If the schema is loaded from a
+    directory on disk (see :func:`load_schema_supplements`), the .json
+    files may be modified at runtime: With the configuration option
+    "ckanext.dcor_schemas.json_resource_schema_reload_interval" set to
+    a positive number of seconds, the modification times of the files
+    are checked at most once per interval and a recompiled index is
+    swapped in if the files changed.
+    """
+    jd = _get_schema_dir()
+    state = _index_state
+    if state is not None and state.schema_dir == jd:
+        if jd == "package":
+            return state.index
+        interval = int(config.get(
+            "ckanext.dcor_schemas.json_resource_schema_reload_interval", 0))
+        if interval <= 0 or time.monotonic() - state.time_checked < interval:
+            return state.index
+    with _index_lock:
+        return _update_supplement_index(jd)
+
+
+def _get_schema_dir():
+    return config.get("ckanext.dcor_schemas.json_resource_schema_dir",
+                      "package")
+
+
+def _get_schema_signature(jd):
+    """Return the modification times and sizes of the schema files"""
+    if jd == "package":
+        return None
+    signature = []
+    with os.scandir(jd) as it:
+        for entry in it:
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                signature.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return sorted(signature)
+
+
+def _update_supplement_index(jd):
+    """(Re)compile the supplement index if necessary (lock acquired)"""
+    global _index_state
+    state = _index_state
+    now = time.monotonic()
+    signature = _get_schema_signature(jd)
+    if state is not None and state.schema_dir == jd:
+        if signature == state.signature:
+            # nothing changed
+            _index_state = state._replace(time_checked=now)
+            return state.index
+        try:
+            index = SupplementIndex(_load_schema_supplements(jd))
+        except BaseException:
+            # e.g. a file is being edited; keep the current index
+            logger.exception(f"Could not reload supplementary resource "
+                             f"schemas from '{jd}'")
+            _index_state = state._replace(time_checked=now)
+            return state.index
+        logger.info(f"Reloaded supplementary resource schemas from '{jd}'")
     else:
-        raise KeyError("Supplement [{}]: '{}' not found!".format(section, key))
+        index = SupplementIndex(_load_schema_supplements(jd))
+    # atomically replace the current index
+    _index_state = _IndexState(schema_dir=jd,
+                               signature=signature,
+                               time_checked=now,
+                               index=index)
+    return index
 
 
-@functools.lru_cache(maxsize=32)
 def load_schema_supplements():
     """Load and merge the entire supplementary resource schema
 
@@ -182,8 +314,11 @@ def load_schema_supplements():
     there. Otherwise, (or if it is set to "package"), the schema shipped
     with this extension is loaded.
     """
+    return get_supplement_index().schemas
+
+
+def _load_schema_supplements(jd):
     # determine the directory from which to load json files
-    jd = config.get("ckanext.dcor_schemas.json_resource_schema_dir", "package")
     if jd == "package":  # use package json files (in this directory here)
         module = "ckanext.dcor_schemas"
         submod = "resource_schema_supplements"
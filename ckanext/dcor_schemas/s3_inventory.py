@@ -0,0 +1,121 @@
+import datetime
+import pathlib
+import sqlite3
+
+
+class InventorySnapshot:
+    def __init__(self, path):
+        """Local SQLite snapshot of the S3 objects of all circle buckets
+
+        The snapshot is written by `dcor-prune-orphaned-s3-artifacts`
+        after listing all buckets. Subsequent incremental runs only
+        list the objects after the last key of each shard in the
+        snapshot (see :func:`get_shard_cursors`), add them to the
+        snapshot, and check the objects in the snapshot against the
+        CKAN database instead of listing all buckets again.
+
+        Use :func:`commit` to persist changes.
+        """
+        self.path = pathlib.Path(path)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            " bucket TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_modified TEXT NOT NULL,"
+            " PRIMARY KEY (bucket, key)"
+            ") WITHOUT ROWID")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            " name TEXT PRIMARY KEY,"
+            " value TEXT"
+            ")")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.conn.rollback()
+        self.conn.close()
+
+    @property
+    def time_created(self):
+        """Time of the last full S3 listing (None if there was none)"""
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE name = 'time_created'").fetchone()
+        return None if row is None else datetime.datetime.fromisoformat(row[0])
+
+    def __contains__(self, item):
+        bucket_name, object_name = item
+        row = self.conn.execute(
+            "SELECT 1 FROM objects WHERE bucket = ? AND key = ?",
+            (bucket_name, object_name)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def add(self, bucket_name, object_name, size, last_modified):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+            (bucket_name, object_name, size, last_modified.isoformat()))
+
+    def clear(self, time_created=None):
+        """Remove all objects (before a full S3 listing)"""
+        if time_created is None:
+            time_created = datetime.datetime.now(datetime.timezone.utc)
+        self.conn.execute("DELETE FROM objects")
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('time_created', ?)",
+            (time_created.isoformat(),))
+
+    def commit(self):
+        self.conn.commit()
+
+    def get_shard_cursors(self):
+        """Return the last key of each shard of each bucket
+
+        Shards are the key prefixes of the second level (e.g.
+        "resource/abc/", see :func:`.s3_scan.iter_bucket_objects`).
+        The returned dictionary maps bucket names to dictionaries
+        mapping shard prefixes to the last key in that shard.
+        """
+        cursors = {}
+        rows = self.conn.execute(
+            "SELECT bucket, key FROM objects ORDER BY bucket, key")
+        for bucket_name, object_name in rows:
+            parts = object_name.split("/")
+            if len(parts) > 2:
+                shard = "/".join(parts[:2]) + "/"
+                cursors.setdefault(bucket_name, {})[shard] = object_name
+        return cursors
+
+    def iter_objects(self, older_than_days=0):
+        """Iterate over objects in the snapshot
+
+        Yields tuples of bucket name, object name, size, and
+        modification time like :func:`.s3_scan.iter_bucket_objects`.
+        Do not modify the snapshot while iterating.
+        """
+        rows = self.conn.execute(
+            "SELECT bucket, key, size, last_modified FROM objects "
+            "ORDER BY bucket, key")
+        threshold = (datetime.datetime.now(datetime.timezone.utc)
+                     - datetime.timedelta(days=older_than_days))
+        for bucket_name, object_name, size, last_modified in rows:
+            last_modified = datetime.datetime.fromisoformat(last_modified)
+            if last_modified > threshold:
+                # Ignore objects that are younger than `older_than_days`
+                continue
+            yield bucket_name, object_name, size, last_modified
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def remove(self, bucket_name, object_name):
+        self.conn.execute("DELETE FROM objects WHERE bucket = ? AND key = ?",
+                          (bucket_name, object_name))
@@ -0,0 +1,139 @@
+import threading
+import time
+
+from dcor_shared import s3, s3cc
+
+
+# The background jobs of a resource all need the same information about
+# the S3 object of a resource. With this cache, a single HEAD request
+# supplies existence, size, ETag, tag count and checksum to all jobs that
+# run in the same worker process within `OBJECT_META_TTL` seconds.
+
+#: Time in seconds for which cached S3 object metadata are valid
+OBJECT_META_TTL = 60
+#: Maximum number of objects in the cache
+OBJECT_META_MAX_SIZE = 1000
+
+#: Error codes of HEAD requests for objects that do not exist
+MISSING_CODES = ["404", "NoSuchKey", "NotFound", "NoSuchBucket"]
+
+_object_meta_cache = {}
+_object_meta_lock = threading.Lock()
+
+
+def get_object_meta(bucket_name, object_name):
+    """Return (cached) metadata of an S3 object
+
+    Returns
+    -------
+    meta: dict
+        Dictionary with the keys "exists", "size", "etag" (without
+        quotes), "tag_count" (None if not reported by S3),
+        "checksum_sha256" (base64-encoded, None if not available),
+        and "checksum_type" (e.g. "FULL_OBJECT" or "COMPOSITE").
+        Metadata of objects that do not exist are not cached. Errors
+        other than "not found" (e.g. access denied) are raised.
+    """
+    key = (bucket_name, object_name)
+    now = time.monotonic()
+    with _object_meta_lock:
+        cached = _object_meta_cache.get(key)
+    if cached is not None and now - cached[0] < OBJECT_META_TTL:
+        return cached[1]
+
+    s3_client, _, _ = s3.get_s3()
+    try:
+        resp = s3_client.head_object(Bucket=bucket_name,
+                                     Key=object_name,
+                                     ChecksumMode="ENABLED")
+    except s3_client.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in MISSING_CODES:
+            # e.g. access denied, throttling, or server errors
+            raise
+        return {"exists": False,
+                "size": None,
+                "etag": None,
+                "tag_count": None,
+                "checksum_sha256": None,
+                "checksum_type": None,
+                }
+
+    headers = resp.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    tag_count = headers.get("x-amz-tagging-count")
+    meta = {"exists": True,
+            "size": resp["ContentLength"],
+            "etag": resp.get("ETag", "").strip("'").strip('"'),
+            "tag_count": None if tag_count is None else int(tag_count),
+            "checksum_sha256": resp.get("ChecksumSHA256"),
+            "checksum_type": resp.get("ChecksumType"),
+            }
+    with _object_meta_lock:
+        if len(_object_meta_cache) >= OBJECT_META_MAX_SIZE:
+            _prune_cache(now)
+        _object_meta_cache[key] = (now, meta)
+    return meta
+
+
+def get_artifact_meta(resource_id, artifact="resource"):
+    """Return (cached) metadata of the S3 object of a resource artifact
+
+    See :func:`get_object_meta` for the returned dictionary.
+    """
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=resource_id, artifact=artifact)
+    return get_object_meta(bucket_name, object_name)
+
+
+def get_object_tags(bucket_name, object_name):
+    """Return the (cached) tags of an existing S3 object
+
+    Returns a list of strings in the form "key=value". If S3 reported
+    that the object has no tags, no request is made.
+    """
+    meta = get_object_meta(bucket_name, object_name)
+    if "tags" not in meta:
+        if meta["tag_count"] == 0:
+            meta["tags"] = []
+        else:
+            s3_client, _, _ = s3.get_s3()
+            resp = s3_client.get_object_tagging(Bucket=bucket_name,
+                                                Key=object_name)
+            meta["tags"] = [f"{item['Key']}={item['Value']}"
+                            for item in resp["TagSet"]]
+    return meta["tags"]
+
+
+def invalidate(bucket_name, object_name):
+    """Remove an S3 object from the cache (e.g. after modifying it)"""
+    with _object_meta_lock:
+        _object_meta_cache.pop((bucket_name, object_name), None)
+
+
+def make_resource_public(resource_id, missing_ok=True):
+    """Make all artifacts of a resource public
+
+    Same as :func:`dcor_shared.s3cc.make_resource_public`, but the
+    tags are only modified (and fetched) if necessary.
+    """
+    for artifact in ["condensed", "preview", "resource"]:
+        bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+            resource_id=resource_id, artifact=artifact)
+        meta = get_object_meta(bucket_name, object_name)
+        if not meta["exists"]:
+            if missing_ok:
+                continue
+        elif "public=true" in get_object_tags(bucket_name, object_name):
+            continue
+        s3.make_object_public(bucket_name=bucket_name,
+                              object_name=object_name,
+                              missing_ok=missing_ok)
+        invalidate(bucket_name, object_name)
+
+
+def _prune_cache(now):
+    """Remove expired entries from the cache (lock must be acquired)"""
+    for key, (time_cached, _) in list(_object_meta_cache.items()):
+        if now - time_cached >= OBJECT_META_TTL:
+            _object_meta_cache.pop(key)
+    if len(_object_meta_cache) >= OBJECT_META_MAX_SIZE:
+        _object_meta_cache.clear()
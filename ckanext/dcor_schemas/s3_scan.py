@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import datetime
+import time
+
+from dcor_shared import s3
+
+from . import move
+
+
+#: Default number of threads for listing S3 objects
+SCAN_JOBS = 8
+#: Default maximum number of deleted S3 objects per second
+DELETE_RATE = 2000
+
+
+def _list_level(bucket_name, prefix):
+    """List objects and common prefixes directly below `prefix`"""
+    s3_client, _, _ = s3.get_s3()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    objects = []
+    prefixes = []
+    try:
+        for page in paginator.paginate(Bucket=bucket_name,
+                                       Prefix=prefix,
+                                       Delimiter="/"):
+            objects += page.get("Contents", [])
+            prefixes += [cp["Prefix"] for cp in page.get("CommonPrefixes", [])]
+    except s3_client.exceptions.NoSuchBucket:
+        # Bucket has been deleted in the meantime
+        pass
+    return objects, prefixes
+
+
+def _list_shard(bucket_name, prefix, start_after=None):
+    """List all objects below `prefix` (recursively)
+
+    If `start_after` is given, only objects with keys that sort after
+    it are listed.
+    """
+    s3_client, _, _ = s3.get_s3()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    kwargs = {"Bucket": bucket_name, "Prefix": prefix}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    objects = []
+    try:
+        for page in paginator.paginate(**kwargs):
+            objects += page.get("Contents", [])
+    except s3_client.exceptions.NoSuchBucket:
+        pass
+    return objects
+
+
+def _get_shards(bucket_name):
+    """Return objects at the top two levels and shard prefixes of a bucket
+
+    The artifacts of a resource are stored as
+    "<artifact>/<rid[:3]>/<rid[3:6]>/<rid[6:]>", so the shards are
+    e.g. "resource/000/" to "resource/fff/".
+    """
+    objects, prefixes = _list_level(bucket_name, "")
+    shards = []
+    for prefix in prefixes:
+        objects_p, shards_p = _list_level(bucket_name, prefix)
+        objects += objects_p
+        shards += shards_p
+    return objects, shards
+
+
+def iter_bucket_objects(bucket_names, older_than_days=0, num_jobs=SCAN_JOBS,
+                        start_after=None):
+    """Concurrently list the objects of multiple buckets
+
+    The buckets are listed concurrently and large buckets are split
+    into shards by key prefix (see :func:`_get_shards`), which are
+    also listed concurrently. The order of the returned objects is
+    not defined.
+
+    Parameters
+    ----------
+    bucket_names: list of str
+        names of the buckets to scan
+    older_than_days: int
+        ignore objects that were modified within the given number of
+        days (set to -1 to include all objects)
+    num_jobs: int
+        number of concurrent list requests
+    start_after: dict
+        for each bucket name, a dictionary mapping shard prefixes to
+        keys; only objects that sort after that key are listed in the
+        shard (see :func:`.InventorySnapshot.get_shard_cursors`)
+
+    Yields
+    ------
+    bucket_name: str
+        name of the bucket
+    object_name: str
+        key of the object
+    size: int
+        size of the object in bytes
+    last_modified: datetime.datetime
+        modification time of the object
+    """
+    def filter_objects(objects):
+        for obj in objects:
+            creation_date = obj["LastModified"]
+            tz = creation_date.tzinfo
+            if creation_date > (datetime.datetime.now(tz=tz)
+                                - datetime.timedelta(days=older_than_days)):
+                # Ignore objects that are younger than `older_than_days`
+                continue
+            yield obj["Key"], obj["Size"], creation_date
+
+    if start_after is None:
+        start_after = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, num_jobs)) as pool:
+        bucket_futures = {pool.submit(_get_shards, bn): bn
+                          for bn in bucket_names}
+        shard_futures = {}
+        for fut in as_completed(bucket_futures):
+            bucket_name = bucket_futures[fut]
+            objects, shards = fut.result()
+            cursors = start_after.get(bucket_name, {})
+            for shard in shards:
+                shard_futures[pool.submit(_list_shard, bucket_name, shard,
+                                          cursors.get(shard))] \
+                    = bucket_name
+            for key, size, lm in filter_objects(objects):
+                yield bucket_name, key, size, lm
+        for fut in as_completed(shard_futures):
+            bucket_name = shard_futures[fut]
+            for key, size, lm in filter_objects(fut.result()):
+                yield bucket_name, key, size, lm
+
+
+class BatchDeleter:
+    def __init__(self, max_rate=DELETE_RATE, dry_run=False):
+        """Rate-limited, batched deletion of S3 objects
+
+        Objects added with :func:`add` are deleted with one
+        `DeleteObjects` request per 1000 objects of a bucket. At most
+        `max_rate` objects are deleted per second.
+        """
+        self.max_rate = max_rate
+        self.dry_run = dry_run
+        self.batches = {}
+        #: number of deleted objects
+        self.count = 0
+        #: number of bytes reclaimed
+        self.size = 0
+        self.time_start = time.monotonic()
+
+    def add(self, bucket_name, object_name, size=0):
+        batch = self.batches.setdefault(bucket_name, [])
+        batch.append((object_name, size))
+        if len(batch) == 1000:
+            self.flush(bucket_name)
+
+    def flush(self, bucket_name=None):
+        """Delete all pending objects (of a bucket)"""
+        if bucket_name is None:
+            for bn in list(self.batches):
+                self.flush(bn)
+            return
+        batch = self.batches.pop(bucket_name, [])
+        if not batch:
+            return
+        if not self.dry_run:
+            # Do not delete more than `max_rate` objects per second
+            if self.max_rate and self.max_rate > 0:
+                time_target = self.time_start + self.count / self.max_rate
+                time.sleep(max(0, time_target - time.monotonic()))
+            move.delete_objects([[bucket_name, obj] for obj, _ in batch])
+        self.count += len(batch)
+        self.size += sum(size for _, size in batch)
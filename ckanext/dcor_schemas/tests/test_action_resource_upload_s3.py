@@ -3,10 +3,13 @@ from unittest import mock
 
 import pytest
 
-from ckan import model
+from ckan import logic, model
 import ckan.tests.helpers as helpers
 import ckan.tests.factories as factories
 from dcor_shared.testing import synchronous_enqueue_job, upload_presigned_to_s3
+from dcor_shared import sha256sum
+
+from ckanext.dcor_schemas import checksum
 
 
 import requests
@@ -100,3 +103,82 @@ def test_action_resource_upload_get_url_and_upload(enqueue_job_mock):
     dlurl = response["upload_urls"][0].split("?")[0]
     retdl = requests.get(dlurl)
     assert retdl.ok
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_action_resource_upload_with_sha256(enqueue_job_mock):
+    """S3 verifies the SHA256 sum and the job does not download the file"""
+    path = data_path / "calibration_beads_47.rtdc"
+    sha256 = sha256sum(path)
+
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+
+    test_context = {'ignore_auth': False,
+                    'user': user['name'], 'model': model, 'api_version': 3}
+
+    response = helpers.call_action("resource_upload_s3_urls",
+                                   test_context,
+                                   organization_id=owner_org["id"],
+                                   file_size=path.stat().st_size,
+                                   sha256=sha256,
+                                   )
+    assert len(response["upload_urls"]) == 1
+    assert response["complete_url"] is None
+    assert "x-amz-checksum-sha256" in response["upload_headers"]
+
+    # Uploading without the checksum header is not allowed
+    retbad = requests.put(response["upload_urls"][0],
+                          data=path.read_bytes())
+    assert not retbad.ok
+
+    retup = requests.put(response["upload_urls"][0],
+                         data=path.read_bytes(),
+                         headers=response["upload_headers"])
+    assert retup.ok
+
+    pkg_dict = helpers.call_action("package_create",
+                                   test_context,
+                                   title="My Test Dataset",
+                                   authors="Peter Parker",
+                                   license_id="CC-BY-4.0",
+                                   state="draft",
+                                   owner_org=owner_org["name"],
+                                   )
+    with mock.patch.object(checksum, "compute_checksum") as cc_mock:
+        helpers.call_action(
+            "package_revise",
+            test_context,
+            match__id=pkg_dict["id"],
+            update__resources__extend=[{"id": response["resource_id"],
+                                        "name": "new_test.rtdc",
+                                        }],
+        )
+    assert not cc_mock.called
+    res_dict = helpers.call_action("resource_show", id=response["resource_id"])
+    assert res_dict["sha256"] == sha256
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_action_resource_upload_with_invalid_sha256():
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    test_context = {'ignore_auth': False,
+                    'user': user['name'], 'model': model, 'api_version': 3}
+    with pytest.raises(logic.ValidationError):
+        helpers.call_action("resource_upload_s3_urls",
+                            test_context,
+                            organization_id=owner_org["id"],
+                            file_size=1024,
+                            sha256="peter",
+                            )
@@ -11,6 +11,9 @@ from ckan import model
 
 from dcor_shared.testing import make_dataset_via_s3, make_resource_via_s3
 
+from ckanext.dcor_schemas import auth as dcor_auth
+from ckanext.dcor_schemas import resource_schema_supplements as rss
+
 
 data_path = pathlib.Path(__file__).parent / "data"
 
@@ -124,6 +127,14 @@ def test_resource_delete_only_drafts():
                           id=rid)
 
 
+def test_resource_editable_metadata_frozen():
+    editable = dcor_auth.resource_editable_metadata()
+    assert isinstance(editable, frozenset)
+    # computed only once
+    assert dcor_auth.resource_editable_metadata() is editable
+    assert editable == set(rss.get_composite_item_list() + ["description"])
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_request_context')
 def test_resource_patch_only_description():
@@ -1,3 +1,6 @@
+import csv
+import datetime
+import json
 import pathlib
 from unittest import mock
 import uuid
@@ -14,6 +17,9 @@ from dcor_shared.testing import (
 )
 from dcor_shared import s3, s3cc
 
+from ckanext.dcor_schemas import cli as dcor_cli
+from ckanext.dcor_schemas import s3_inventory, s3_scan
+
 
 data_path = pathlib.Path(__file__).parent / "data"
 
@@ -77,6 +83,184 @@ def test_dcor_move_dataset_to_circle(enqueue_job_mock, cli):
                                     object_name=other_key)
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_dcor_move_dataset_to_circle_etag_no_rehash(enqueue_job_mock, cli):
+    """Copies are verified via ETag, the data are not downloaded"""
+    user = factories.User()
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+
+    ds_dict, rs_dict = make_dataset_via_s3(
+        create_context=create_context,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True,
+    )
+    bucket_name_old, resource_key = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=rs_dict["id"],
+        artifact="resource"
+    )
+    s3_client, _, _ = s3.get_s3()
+    etag_old = s3_client.head_object(Bucket=bucket_name_old,
+                                     Key=resource_key)["ETag"]
+
+    new_owner_org = factories.Organization(
+        users=[{
+            'name': user["id"],
+            'capacity': 'admin'
+        }])
+    bucket_name_new = bucket_name_old.replace(ds_dict["owner_org"],
+                                              new_owner_org["id"])
+
+    with mock.patch("ckanext.dcor_schemas.checksum.compute_checksum") \
+            as cc_mock:
+        res = cli.invoke(ckan_cli, ["dcor-move-dataset-to-circle",
+                                    ds_dict["id"],
+                                    new_owner_org["id"],
+                                    "--jobs", "3",
+                                    ])
+    assert res.exit_code == 0
+    assert not cc_mock.called
+    assert res.output.count("...copied S3 object") == 3
+    etag_new = s3_client.head_object(Bucket=bucket_name_new,
+                                     Key=resource_key)["ETag"]
+    assert etag_new == etag_old
+    assert not s3.object_exists(bucket_name=bucket_name_old,
+                                object_name=resource_key)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas dc_serve dc_view')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_dcor_move_datasets_to_circle(enqueue_job_mock, cli, tmp_path):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_ids = []
+    for ii in range(2):
+        ds_dict, _ = make_dataset_via_s3(
+            create_context=create_context,
+            owner_org=owner_org,
+            resource_path=data_path / "calibration_beads_47.rtdc",
+            activate=True,
+        )
+        ds_ids.append(ds_dict["id"])
+    new_owner_org = factories.Organization(
+        users=[{
+            'name': user["id"],
+            'capacity': 'admin'
+        }])
+
+    journal = tmp_path / "journal.jsonl"
+    res = cli.invoke(ckan_cli, ["dcor-move-datasets-to-circle",
+                                new_owner_org["id"],
+                                "--source-circle", owner_org["id"],
+                                "--journal", str(journal),
+                                "--batch-size", "1",
+                                ])
+    assert res.exit_code == 0
+    assert "Moving 2 datasets" in res.output
+    steps = [json.loads(line)["step"]
+             for line in journal.read_text().split("\n") if line]
+    assert steps.count("copied") == 2
+    assert steps.count("db_updated") == 2
+    assert steps.count("deleted") == 2
+
+    for ds_id in ds_ids:
+        ds_dict = helpers.call_action("package_show", id=ds_id)
+        assert ds_dict["owner_org"] == new_owner_org["id"]
+        rs_dict = ds_dict["resources"][0]
+        assert rs_dict["s3_url"].count(new_owner_org["id"])
+        bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+            resource_id=rs_dict["id"], artifact="resource")
+        assert bucket_name.count(new_owner_org["id"])
+        assert s3.object_exists(bucket_name=bucket_name,
+                                object_name=object_name)
+        assert not s3.object_exists(
+            bucket_name=bucket_name.replace(new_owner_org["id"],
+                                            owner_org["id"]),
+            object_name=object_name)
+
+    # Running again does not do anything
+    res2 = cli.invoke(ckan_cli, ["dcor-move-datasets-to-circle",
+                                 new_owner_org["id"],
+                                 "--source-circle", owner_org["id"],
+                                 "--journal", str(journal),
+                                 ])
+    assert res2.exit_code == 0
+    assert "Moving 0 datasets" in res2.output
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_run_jobs_dcor_schemas_checkpoint(enqueue_job_mock, cli, tmp_path):
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    path_checkpoint = tmp_path / "checkpoint.txt"
+    result = cli.invoke(ckan_cli, ["run-jobs-dcor-schemas",
+                                   "--checkpoint", str(path_checkpoint)])
+    assert result.exit_code == 0
+    assert "Processed 1/1" in result.output
+    assert path_checkpoint.read_text().split() == [res_dict["id"]]
+
+    # resume from checkpoint
+    result2 = cli.invoke(ckan_cli, ["run-jobs-dcor-schemas",
+                                    "--checkpoint", str(path_checkpoint)])
+    assert result2.exit_code == 0
+    assert "Resuming from checkpoint (1 resources done)" in result2.output
+    assert "OK:" not in result2.output
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_run_jobs_dcor_schemas_workers(cli):
+    # No background jobs are run, so the SHA256 sum is not computed.
+    res_ids = []
+    for _ in range(2):
+        ds_dict, res_dict = make_dataset_via_s3(
+            resource_path=data_path / "calibration_beads_47.rtdc",
+            activate=False)
+        res_ids.append(res_dict["id"])
+    result = cli.invoke(ckan_cli, ["run-jobs-dcor-schemas",
+                                   "--workers", "2"])
+    assert result.exit_code == 0
+    assert "Processed 2/2" in result.output
+    for rid in res_ids:
+        resource = helpers.call_action("resource_show", id=rid)
+        assert len(resource["sha256"]) == 64
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_run_jobs_dcor_schemas_plan(cli):
+    # No background jobs are run, so the SHA256 sum is not computed.
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=False)
+    result = cli.invoke(ckan_cli, ["run-jobs-dcor-schemas", "--plan"])
+    assert result.exit_code == 0
+    assert "Pending jobs for 1 resources" in result.output
+    for line in result.output.split("\n"):
+        if line.count("sha256 hash"):
+            assert line.split()[0] == "1"
+            break
+    else:
+        assert False, "SHA256 job not in plan"
+    assert "OK:" not in result.output
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
 @pytest.mark.parametrize("activate", [True, False])
@@ -124,6 +308,35 @@ def test_list_group_resources_delete_purge(cli, activate):
     assert res_dict["id"] not in result2.output.strip().split()
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_get_group_resource_ids():
+    """All group resources are loaded with one query"""
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=False)
+    org_id = ds_dict['organization']['id']
+    group_resources = dcor_cli.get_group_resource_ids()
+    assert group_resources[org_id] == {res_dict["id"]}
+    assert group_resources[org_id] == {
+        r.resource_id for r in dcor_cli.iter_group_resources(org_id)}
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_iter_group_resources_rows():
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    org_id = ds_dict['organization']['id']
+    rows = list(dcor_cli.iter_group_resources(org_id, yield_per=1))
+    assert len(rows) == 1
+    assert rows[0].group_id == org_id
+    assert rows[0].package_id == ds_dict["id"]
+    assert rows[0].resource_id == res_dict["id"]
+    assert rows[0].state == "active"
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
 def test_list_zombie_users_basic_clean_db(cli):
@@ -163,6 +376,39 @@ def test_list_zombie_users_with_a_user(cli):
         assert False, "test_user should have been found"
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+@pytest.mark.parametrize("output_format", ["json", "csv"])
+def test_list_zombie_users_format(cli, output_format):
+    user = factories.User(name=f"test_user_{uuid.uuid4()}")
+    user_ds = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user_ds['id'],
+        'capacity': 'admin'
+    }])
+    make_dataset_via_s3(
+        {'ignore_auth': False, 'user': user_ds['name'], 'api_version': 3},
+        owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    result = cli.invoke(ckan_cli,
+                        ["list-zombie-users",
+                         "--last-activity-weeks", "0",
+                         "--format", output_format])
+    assert result.exit_code == 0
+    # ignore log messages
+    output = "\n".join(line for line in result.output.split("\n")
+                       if not line.count("INFO") and not line.count("WARNI"))
+    if output_format == "json":
+        users = json.loads(output)
+    else:
+        users = list(csv.DictReader(output.strip().split("\n")))
+    names = [u["name"] for u in users]
+    assert user["name"] in names
+    assert user_ds["name"] not in names
+    assert users[names.index(user["name"])]["id"] == user["id"]
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
 def test_list_zombie_users_with_a_user_with_dataset(cli):
@@ -280,6 +526,42 @@ def test_dcor_prune_draft_datasets(cli):
         helpers.call_action("package_show", id=ds_dict["id"])
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_dcor_prune_draft_datasets_batches(enqueue_job_mock, cli):
+    ds_ids = []
+    objects = []
+    for _ in range(3):
+        ds_dict, res_dict = make_dataset_via_s3(
+            resource_path=data_path / "calibration_beads_47.rtdc",
+            activate=False)
+        ds_ids.append(ds_dict["id"])
+        objects.append(s3cc.get_s3_bucket_object_for_artifact(
+            resource_id=res_dict["id"], artifact="resource"))
+    active_dict, _ = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+
+    res = cli.invoke(ckan_cli,
+                     ["dcor-prune-draft-datasets",
+                      "--older-than-days", "-1",
+                      "--batch-size", "2",
+                      ])
+    print(res.output)
+    assert res.exit_code == 0
+    assert "Number of draft datasets found:   3" in res.output
+    for ds_id in ds_ids:
+        with pytest.raises(logic.NotFound):
+            helpers.call_action("package_show", id=ds_id)
+    for bucket_name, object_name in objects:
+        assert not s3.object_exists(bucket_name=bucket_name,
+                                    object_name=object_name)
+    # active datasets are not touched
+    assert helpers.call_action("package_show", id=active_dict["id"])
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
 def test_dcor_prune_orphaned_s3_artifacts(cli):
@@ -349,6 +631,149 @@ def test_dcor_prune_orphaned_s3_artifacts(cli):
     assert not s3.object_exists(bucket_name, object_name)
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_dcor_prune_orphaned_s3_artifacts_incremental(cli, tmp_path):
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        res_dict["id"])
+    snapshot = tmp_path / "inventory.sqlite"
+
+    # incremental run requires a snapshot
+    res = cli.invoke(ckan_cli,
+                     ["dcor-prune-orphaned-s3-artifacts",
+                      "--older-than-days", "-1",
+                      "--snapshot", str(snapshot),
+                      "--incremental"])
+    assert res.exit_code != 0
+
+    # full run creates the snapshot
+    res = cli.invoke(ckan_cli,
+                     ["dcor-prune-orphaned-s3-artifacts",
+                      "--older-than-days", "-1",
+                      "--snapshot", str(snapshot)])
+    assert res.exit_code == 0
+    with s3_inventory.InventorySnapshot(snapshot) as inventory:
+        assert (bucket_name, object_name) in [
+            (bn, obj) for bn, obj, _, _ in inventory.iter_objects(-1)]
+
+    # Delete the entire dataset
+    helpers.call_action(action_name="package_delete",
+                        context={'ignore_auth': True, 'user': 'default'},
+                        id=ds_dict["id"]
+                        )
+    helpers.call_action(action_name="dataset_purge",
+                        context={'ignore_auth': True, 'user': 'default'},
+                        id=ds_dict["id"]
+                        )
+    assert s3.object_exists(bucket_name, object_name)
+
+    # incremental run only lists objects after the last inventory key
+    with mock.patch.object(s3_scan, "iter_bucket_objects",
+                           wraps=s3_scan.iter_bucket_objects) as scan_mock:
+        res = cli.invoke(ckan_cli,
+                         ["dcor-prune-orphaned-s3-artifacts",
+                          "--older-than-days", "-1",
+                          "--snapshot", str(snapshot),
+                          "--incremental"])
+    assert res.exit_code == 0
+    for call in scan_mock.call_args_list:
+        if bucket_name in call.args[0]:
+            cursors = call.kwargs["start_after"][bucket_name]
+            assert object_name in cursors.values()
+    assert not s3.object_exists(bucket_name, object_name)
+    with s3_inventory.InventorySnapshot(snapshot) as inventory:
+        assert (bucket_name, object_name) not in [
+            (bn, obj) for bn, obj, _, _ in inventory.iter_objects(-1)]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_dcor_prune_orphaned_s3_artifacts_incremental_new(cli, tmp_path):
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        res_dict["id"])
+    s3_client, _, _ = s3.get_s3()
+    snapshot = tmp_path / "inventory.sqlite"
+
+    # young orphan (uploaded, but never became a resource)
+    rid_young = str(uuid.uuid4())
+    while rid_young[:3] == res_dict["id"][:3]:
+        # must not be in the same shard as the resource
+        rid_young = str(uuid.uuid4())
+    obj_young = f"resource/{rid_young[:3]}/{rid_young[3:6]}/{rid_young[6:]}"
+    s3_client.put_object(Bucket=bucket_name, Key=obj_young, Body=b"pan")
+
+    # full run keeps and stores the young orphan
+    res = cli.invoke(ckan_cli,
+                     ["dcor-prune-orphaned-s3-artifacts",
+                      "--older-than-days", "1",
+                      "--snapshot", str(snapshot)])
+    assert res.exit_code == 0
+    assert s3.object_exists(bucket_name, obj_young)
+    with s3_inventory.InventorySnapshot(snapshot) as inventory:
+        assert (bucket_name, obj_young) in inventory
+
+    # orphan uploaded after the full run (sorts after the last key)
+    obj_new = object_name + "-peter"
+    s3_client.put_object(Bucket=bucket_name, Key=obj_new, Body=b"pan")
+
+    # incremental run finds the new orphan and prunes the old orphan
+    res = cli.invoke(ckan_cli,
+                     ["dcor-prune-orphaned-s3-artifacts",
+                      "--older-than-days", "-1",
+                      "--snapshot", str(snapshot),
+                      "--incremental"])
+    assert res.exit_code == 0
+    assert "1 new" in res.output
+    assert not s3.object_exists(bucket_name, obj_young)
+    assert not s3.object_exists(bucket_name, obj_new)
+    assert s3.object_exists(bucket_name, object_name)
+    with s3_inventory.InventorySnapshot(snapshot) as inventory:
+        assert (bucket_name, obj_young) not in inventory
+        assert (bucket_name, obj_new) not in inventory
+        assert (bucket_name, object_name) in inventory
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_dcor_prune_orphaned_s3_artifacts_scan_sharded():
+    ds_dict, res_dict = make_dataset_via_s3(
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=True)
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        res_dict["id"])
+    s3_client, _, _ = s3.get_s3()
+    # objects that are not in a shard must be found as well
+    s3_client.put_object(Bucket=bucket_name, Key="peter", Body=b"pan")
+    s3_client.put_object(Bucket=bucket_name, Key="resource/peter",
+                         Body=b"hook")
+    found = {obj: size for bn, obj, size, _ in s3_scan.iter_bucket_objects(
+        [bucket_name], older_than_days=-1, num_jobs=3)
+        if bn == bucket_name}
+    size = (data_path / "calibration_beads_47.rtdc").stat().st_size
+    assert found[object_name] == size
+    assert found["peter"] == 3
+    assert found["resource/peter"] == 4
+
+    deleter = s3_scan.BatchDeleter(dry_run=True)
+    deleter.add(bucket_name, "peter", 3)
+    deleter.add(bucket_name, "resource/peter", 4)
+    deleter.flush()
+    assert deleter.count == 2
+    assert deleter.size == 7
+    assert s3.object_exists(bucket_name, "peter")
+
+    deleter = s3_scan.BatchDeleter()
+    deleter.add(bucket_name, "peter", 3)
+    deleter.flush()
+    assert not s3.object_exists(bucket_name, "peter")
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
 def test_dcor_purge_unused_collections_and_circles(cli):
@@ -421,8 +846,11 @@ def test_dcor_purge_unused_collections_and_circles(cli):
     res = cli.invoke(ckan_cli,
                      ["dcor-purge-unused-collections-and-circles",
                       "--modified-before-months", "0",
-                      "--dry-run"])
+                      "--dry-run",
+                      "--batch-size", "1"])
     assert res.exit_code == 0
+    assert "Processed 1/2" in res.output
+    assert "Processed 2/2" in res.output
     assert helpers.call_action("group_show",
                                context,
                                id=group_keep["id"]
@@ -441,9 +869,14 @@ def test_dcor_purge_unused_collections_and_circles(cli):
                                )["id"] == circle_remove["id"]
 
     # But if we actually remove things, only the *_keep stuff should stay
-    res = cli.invoke(ckan_cli,
-                     ["dcor-purge-unused-collections-and-circles",
-                      "--modified-before-months", "0"])
+    with mock.patch.object(model.repo, "commit_and_remove",
+                           wraps=model.repo.commit_and_remove) as commit:
+        res = cli.invoke(ckan_cli,
+                         ["dcor-purge-unused-collections-and-circles",
+                          "--modified-before-months", "0",
+                          "--batch-size", "2"])
+        # one transaction for both groups
+        assert commit.call_count == 1
     assert res.exit_code == 0
     assert helpers.call_action("group_show",
                                context,
@@ -465,3 +898,25 @@ def test_dcor_purge_unused_collections_and_circles(cli):
                             context,
                             id=circle_remove["id"]
                             )
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_get_unused_groups_with_children():
+    group_parent = factories.Group()
+    group_child = factories.Group()
+    # make `group_child` a child of `group_parent` (like ckanext-hierarchy)
+    model.Session.add(model.Member(group_id=group_child["id"],
+                                   table_id=group_parent["id"],
+                                   table_name="group",
+                                   capacity="parent",
+                                   state="active"))
+    model.Session.commit()
+    parent_obj = model.Group.get(group_parent["id"])
+    assert [g.id for g in parent_obj.get_children_groups()] \
+        == [group_child["id"]]
+
+    unused = [gid for gid, _ in dcor_cli.get_unused_groups(
+        created_before=datetime.datetime.now() + datetime.timedelta(days=1))]
+    assert group_child["id"] in unused
+    assert group_parent["id"] not in unused
@@ -7,6 +7,7 @@ A common approach is to use the mock package to replace the
 ckan.plugins.toolkit.enqueue_job function with a mock that executes jobs
 synchronously instead of asynchronously
 """
+import cgi
 import pathlib
 from unittest import mock
 
@@ -20,7 +21,9 @@ from ckan.tests import helpers
 from dcor_shared.testing import (
     make_dataset_via_s3, make_resource_via_s3, synchronous_enqueue_job
 )
-from dcor_shared import sha256sum
+from dcor_shared import s3, s3cc, sha256sum
+
+from ckanext.dcor_schemas import checksum, jobs, s3_meta
 
 
 data_dir = pathlib.Path(__file__).parent / "data"
@@ -194,3 +197,441 @@ def test_set_sha256_job_empty_file(enqueue_job_mock, tmp_path):
     resource = helpers.call_action("resource_show", id=rid)
     sha256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
     assert resource["sha256"] == sha256
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_compute_checksum_parallel_small_chunks(enqueue_job_mock):
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_dir / "calibration_beads_47.rtdc",
+        activate=False)
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=res_dict["id"], artifact="resource")
+    progress = []
+    sha = checksum.compute_checksum(
+        bucket_name=bucket_name,
+        object_name=object_name,
+        chunk_size=2**14,
+        num_threads=3,
+        num_buffers=4,
+        progress_callback=lambda done, total: progress.append((done, total)))
+    assert sha == sha256sum(data_dir / "calibration_beads_47.rtdc")
+    size = (data_dir / "calibration_beads_47.rtdc").stat().st_size
+    assert len(progress) == -(-size // 2**14)
+    assert progress[-1] == (size, size)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_s3_meta_cache_single_head_request(enqueue_job_mock):
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_dir / "calibration_beads_47.rtdc",
+        activate=True)
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=res_dict["id"], artifact="resource")
+    s3_meta.invalidate(bucket_name, object_name)
+    s3_client, _, _ = s3.get_s3()
+    with mock.patch.object(s3_client, "head_object",
+                           wraps=s3_client.head_object) as head_mock:
+        meta = s3_meta.get_artifact_meta(res_dict["id"])
+        assert jobs.get_resource_etag({"id": res_dict["id"]}) == meta["etag"]
+        assert meta["exists"]
+        assert meta["size"] == res_dict["size"]
+        # the dataset is public, so the object has the public tag already
+        s3_meta.make_resource_public(res_dict["id"])
+        assert "public=true" in s3_meta.get_object_tags(bucket_name,
+                                                        object_name)
+        resource_calls = [c for c in head_mock.call_args_list
+                          if c.kwargs["Key"] == object_name]
+        assert len(resource_calls) == 1
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_s3_meta_errors():
+    s3_client, _, _ = s3.get_s3()
+    bucket_name = "dcor-schemas-test-meta-errors"
+    object_name = "resource/peter/pan"
+    s3_meta.invalidate(bucket_name, object_name)
+    for code in ["404", "NoSuchKey"]:
+        error = s3_client.exceptions.ClientError(
+            {"Error": {"Code": code}}, "HeadObject")
+        with mock.patch.object(s3_client, "head_object", side_effect=error):
+            assert not s3_meta.get_object_meta(bucket_name,
+                                               object_name)["exists"]
+    # other errors (e.g. access denied) are not "object does not exist"
+    error = s3_client.exceptions.ClientError(
+        {"Error": {"Code": "403"}}, "HeadObject")
+    with mock.patch.object(s3_client, "head_object",
+                           side_effect=error) as head_mock:
+        for _ in range(2):
+            with pytest.raises(s3_client.exceptions.ClientError):
+                s3_meta.get_object_meta(bucket_name, object_name)
+        # errors are not cached
+        assert head_mock.call_count == 2
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_set_dc_sanity_passed_job(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    # Note: `call_action` bypasses authorization!
+    # create 1st dataset
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    _, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        resource_path=data_dir / "calibration_beads_47.rtdc",
+        owner_org=owner_org,
+        activate=False)
+
+    resource = helpers.call_action("resource_show", id=res_dict["id"])
+    assert resource["dc_sanity_passed"] is True
+    assert resource["dc_sanity_etag"] == resource["etag"]
+    # format and config metadata are set by the same job
+    assert resource["format"] == "RT-FDC"
+    assert resource["dc:experiment:event count"] == 47
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_set_dc_metadata_job_no_s3_object(enqueue_job_mock):
+    _, res_dict = make_dataset_via_s3(
+        resource_path=data_dir / "calibration_beads_47.rtdc",
+        activate=False)
+    etag = res_dict["etag"]
+    # remove the resource from S3
+    bucket_name, object_name = s3cc.get_s3_bucket_object_for_artifact(
+        resource_id=res_dict["id"], artifact="resource")
+    s3_client, _, _ = s3.get_s3()
+    s3_client.delete_object(Bucket=bucket_name, Key=object_name)
+    s3_meta.invalidate(bucket_name, object_name)
+
+    # a resource without an ETag and a sanity-check verdict
+    resource = dict(res_dict)
+    for key in ["etag", "dc_sanity_passed", "dc_sanity_etag"]:
+        resource.pop(key, None)
+    with mock.patch.object(jobs, "patch_resource_noauth") as patch:
+        assert not jobs.job_set_dc_metadata(resource)
+        assert not patch.called
+
+    resource = helpers.call_action("resource_show", id=res_dict["id"])
+    assert resource["dc_sanity_etag"] == etag
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_patch_resource_noauth_coalesce(enqueue_job_mock, tmp_path):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    ds_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        activate=False)
+    rids = []
+    for ii in range(2):
+        path = tmp_path / f"test_{ii}.txt"
+        path.write_text(f"resource {ii}")
+        rids.append(make_resource_via_s3(
+            resource_path=path,
+            organization_id=owner_org['id'],
+            dataset_id=ds_dict['id'],
+        ))
+
+    # buffer two patches without flushing them
+    with mock.patch.object(jobs, "flush_resource_patches"):
+        for rid in rids:
+            jobs.patch_resource_noauth(package_id=ds_dict["id"],
+                                       resource_id=rid,
+                                       data_dict={"sha256": rid[:8]})
+    for rid in rids:
+        resource = helpers.call_action("resource_show", id=rid)
+        assert resource["sha256"] != rid[:8]
+
+    # write both patches with one call to `package_revise`
+    with mock.patch.object(jobs, "revise_resources_noauth",
+                           wraps=jobs.revise_resources_noauth) as revise:
+        jobs.flush_resource_patches(ds_dict["id"], debounce=0)
+        assert revise.call_count == 1
+    for rid in rids:
+        resource = helpers.call_action("resource_show", id=rid)
+        assert resource["sha256"] == rid[:8]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_patch_resource_noauth_failed_discarded(enqueue_job_mock, tmp_path):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        resource_path=data_dir / "calibration_beads_47.rtdc",
+        activate=True)
+    rid = res_dict["id"]
+    redis_conn = jobs.connect_to_redis()
+    key_patches = f"{jobs.PATCH_REDIS_PREFIX}:{ds_dict['id']}"
+    key_failed = f"{jobs.PATCH_FAILED_REDIS_PREFIX}:{ds_dict['id']}"
+
+    with mock.patch.object(jobs, "flush_resource_patches"):
+        jobs.patch_resource_noauth(package_id=ds_dict["id"],
+                                   resource_id=rid,
+                                   data_dict={"sha256": "hans"})
+
+    # a patch that cannot be written is moved to the failed list
+    with mock.patch.object(jobs, "revise_resources_noauth",
+                           side_effect=lambda pid, patches: dict(patches)):
+        jobs.flush_resource_patches(ds_dict["id"], debounce=0)
+    assert redis_conn.llen(key_patches) == 0
+    assert redis_conn.llen(key_failed) == 1
+
+    # and does not block later patches
+    jobs.patch_resource_noauth(package_id=ds_dict["id"],
+                               resource_id=rid,
+                               data_dict={"sha256": "peter"})
+    resource = helpers.call_action("resource_show", id=rid)
+    assert resource["sha256"] == "peter"
+    assert redis_conn.llen(key_failed) == 1
+
+    # errors when flushing do not hide errors of the job
+    with mock.patch.object(jobs, "flush_resource_patches",
+                           side_effect=ValueError("database gone")):
+        with pytest.raises(KeyError):
+            with jobs.deferred_resource_patches(ds_dict["id"]):
+                raise KeyError("job failed")
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_patch_resource_noauth_no_debounce_single(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        resource_path=data_dir / "calibration_beads_47.rtdc",
+        activate=True)
+
+    # a single pending patch is written without waiting
+    with mock.patch.object(jobs.time, "sleep") as sleep:
+        jobs.patch_resource_noauth(package_id=ds_dict["id"],
+                                   resource_id=res_dict["id"],
+                                   data_dict={"sha256": "peter"})
+        assert not sleep.called
+    resource = helpers.call_action("resource_show", id=res_dict["id"])
+    assert resource["sha256"] == "peter"
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_flush_resource_patches_lock_timeout():
+    package_id = "dcor-schemas-test-lock-timeout"
+    redis_conn = jobs.connect_to_redis()
+    lock = redis_conn.lock(f"{jobs.PATCH_REDIS_PREFIX}:{package_id}:lock",
+                           timeout=10)
+    assert lock.acquire(blocking=False)
+    try:
+        with mock.patch.object(jobs, "PATCH_LOCK_WAIT", 0.1):
+            with pytest.raises(TimeoutError, match="Could not acquire"):
+                jobs.flush_resource_patches(package_id, debounce=0)
+    finally:
+        lock.release()
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_enqueue_dataset_jobs(enqueue_job_mock, tmp_path):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    ds_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        activate=False)
+    rids = []
+    # do not run any jobs when creating the resources
+    with mock.patch.object(jobs, "enqueue_dataset_jobs"):
+        for ii in range(3):
+            path = tmp_path / f"test_{ii}.txt"
+            path.write_text(f"resource {ii}")
+            rids.append(make_resource_via_s3(
+                resource_path=path,
+                organization_id=owner_org['id'],
+                dataset_id=ds_dict['id'],
+            ))
+    for rid in rids:
+        resource = helpers.call_action("resource_show", id=rid)
+        assert not resource.get("sha256")
+
+    enqueue_job_mock.reset_mock()
+    jobs.enqueue_dataset_jobs(ds_dict["id"], rids)
+    # one job per stage for all resources
+    job_list = jobs.RQJob.get_all_job_methods_in_order(ckanext="dcor_schemas")
+    assert enqueue_job_mock.call_count == len(job_list)
+    for rid in rids:
+        resource = helpers.call_action("resource_show", id=rid)
+        assert len(resource["sha256"]) == 64
+        assert resource["s3_available"]
+
+    # jobs are not enqueued twice
+    enqueue_job_mock.reset_mock()
+    jobs.enqueue_dataset_jobs(ds_dict["id"], rids)
+    assert enqueue_job_mock.call_count == 0
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job')
+def test_enqueue_dataset_jobs_legacy_upload(enqueue_job_mock):
+    """Jobs must not be enqueued twice for `resource_create`"""
+    create_context = {'ignore_auth': True,
+                      'user': "default",
+                      'api_version': 3}
+    ds_dict = make_dataset_via_s3(activate=False)
+    enqueue_job_mock.reset_mock()
+    path = data_dir / "calibration_beads_47.rtdc"
+    with path.open('rb') as fd:
+        upload = cgi.FieldStorage()
+        upload.filename = path.name
+        upload.file = fd
+        helpers.call_action("resource_create", create_context,
+                            package_id=ds_dict["id"],
+                            upload=upload,
+                            url="upload",
+                            name=path.name,
+                            )
+    job_list = jobs.RQJob.get_all_job_methods_in_order(ckanext="dcor_schemas")
+    assert enqueue_job_mock.call_count == len(job_list)
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_run_dataset_job_stage_error(enqueue_job_mock, tmp_path):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    ds_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        activate=False)
+    rids = []
+    # do not run any jobs when creating the resources
+    with mock.patch.object(jobs, "enqueue_dataset_jobs"):
+        for ii in range(2):
+            path = tmp_path / f"test_{ii}.txt"
+            path.write_text(f"resource {ii}")
+            rids.append(make_resource_via_s3(
+                resource_path=path,
+                organization_id=owner_org['id'],
+                dataset_id=ds_dict['id'],
+            ))
+    # only set the batch markers
+    with mock.patch('ckan.plugins.toolkit.enqueue_job'):
+        jobs.enqueue_dataset_jobs(ds_dict["id"], rids)
+    assert jobs.has_dataset_jobs(rids[0])
+    assert jobs.has_dataset_jobs(rids[1])
+
+    enqueue_job_mock.reset_mock()
+    with mock.patch.object(s3_meta, "get_artifact_meta",
+                           side_effect=[OSError("S3 is down"),
+                                        {"etag": "a" * 32}]):
+        with pytest.raises(RuntimeError, match=rids[0]):
+            jobs.run_dataset_job_stage("job_set_etag", ds_dict["id"], rids)
+
+    # the jobs of the failed resource may be enqueued again
+    assert not jobs.has_dataset_jobs(rids[0])
+    assert jobs.has_dataset_jobs(rids[1])
+    # the other resource was processed
+    resource = helpers.call_action("resource_show", id=rids[1])
+    assert resource["etag"] == "a" * 32
+    # and the dependent stage was enqueued for it
+    stages = [cc.args[1] for cc in enqueue_job_mock.call_args_list]
+    assert stages == [["job_set_dc_metadata", ds_dict["id"], [rids[1]]]]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_run_dataset_job_stage_single_lookup(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    ds_dict, res_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        resource_path=data_dir / "calibration_beads_47.rtdc",
+        activate=True)
+
+    get_action = jobs.logic.get_action
+    for job_name in ["job_set_resource_metadata_base",
+                     "job_set_s3_resource_public_tag"]:
+        with mock.patch.object(jobs.logic, "get_action",
+                               wraps=get_action) as ga:
+            jobs.run_dataset_job_stage(job_name, ds_dict["id"],
+                                       [res_dict["id"]])
+        actions = [cc.args[0] for cc in ga.call_args_list]
+        # the dataset is only fetched once for all resources
+        assert actions.count("package_show") == 1
+        assert "resource_show" not in actions
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_enqueue_dataset_jobs_error():
+    package_id = "dcor-schemas-test-enqueue-error"
+    rid = "dcor-schemas-test-enqueue-error-resource"
+    with mock.patch('ckan.plugins.toolkit.enqueue_job',
+                    side_effect=ConnectionError("Redis gone")):
+        with pytest.raises(ConnectionError):
+            jobs.enqueue_dataset_jobs(package_id, [rid])
+    # the resource is not blocked
+    assert not jobs.has_dataset_jobs(rid)
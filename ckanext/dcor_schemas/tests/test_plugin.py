@@ -5,6 +5,7 @@ import pytest
 
 import ckan.logic as logic
 import ckan.model as model
+import ckan.plugins as plugins
 import ckan.tests.factories as factories
 import ckan.tests.helpers as helpers
 
@@ -14,6 +15,8 @@ from dcor_shared.testing import (
     synchronous_enqueue_job
 )
 
+from ckanext.dcor_schemas import helpers as dcor_helpers
+
 import requests
 
 data_path = pathlib.Path(__file__).parent / "data"
@@ -168,3 +171,58 @@ def test_ipackagecontroller_after_dataset_update_make_private_public_on_s3(
     response = requests.get(res_dict["s3_url"])
     assert response.ok
     assert response.status_code == 200
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+@mock.patch('ckan.plugins.toolkit.enqueue_job',
+            side_effect=synchronous_enqueue_job)
+def test_package_dict_cached_in_context(enqueue_job_mock):
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'model': model, 'api_version': 3}
+    ds_dict, _ = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        resource_path=data_path / "calibration_beads_47.rtdc",
+        activate=False)
+
+    context = {'ignore_auth': False,
+               'user': user['name'], 'model': model, 'session': model.Session,
+               'api_version': 3}
+    pkg_dict = dcor_helpers.get_package_dict(context, ds_dict["id"])
+    # the same dictionary is returned for copies of the context
+    assert dcor_helpers.get_package_dict(
+        dict(context), ds_dict["id"]) is pkg_dict
+
+    # modifying the dataset invalidates the cache
+    helpers.call_action("package_patch", dict(create_context),
+                        id=ds_dict["id"], title="A new title")
+    pkg_dict_new = dcor_helpers.get_package_dict(context, ds_dict["id"])
+    assert pkg_dict_new is not pkg_dict
+    assert pkg_dict_new["title"] == "A new title"
+
+    dcor_helpers.invalidate_package_dict(context, ds_dict["id"])
+    assert not context["dcor_schemas_package_show_cache"]
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('with_plugins')
+def test_package_schemas_cached():
+    plugin = plugins.get_plugin('dcor_schemas')
+    for method in [plugin.create_package_schema,
+                   plugin.update_package_schema,
+                   plugin.show_package_schema]:
+        schema = method()
+        assert "sp:cells:organism" in schema["resources"]
+        # modifying a schema does not modify the cached schema
+        schema.pop("authors")
+        schema["resources"]["sp:cells:organism"].append(None)
+        schema2 = method()
+        assert schema2 is not schema
+        assert "authors" in schema2
+        assert None not in schema2["resources"]["sp:cells:organism"]
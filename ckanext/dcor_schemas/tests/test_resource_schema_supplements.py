@@ -1,3 +1,8 @@
+import json
+import os
+import pathlib
+import shutil
+
 from ckanext.dcor_schemas import resource_schema_supplements as rss
 import pytest
 
@@ -80,6 +85,66 @@ def test_load():
     rss.load_schema_supplements()
 
 
+def test_supplement_index():
+    index = rss.get_supplement_index()
+    # compiled only once
+    assert rss.get_supplement_index() is index
+    assert index.schemas is rss.load_schema_supplements()
+    assert list(index.composite_keys) == rss.get_composite_item_list()
+    entry = index.composite_items["sp:cells:organism"]
+    assert entry is index.get_entry("cells", "organism")
+    assert entry.item is rss.get_item("cells", "organism")
+    assert entry.parser is rss.PARSERS["string"]
+    with pytest.raises(KeyError, match="not found"):
+        index.get_entry("cells", "peter pan")
+    with pytest.raises(TypeError):
+        index.items[("cells", "peter pan")] = entry
+
+
+def test_supplement_index_reload(tmp_path, monkeypatch):
+    src = pathlib.Path(rss.__file__).parent
+    for path in src.glob("*.json"):
+        shutil.copy2(path, tmp_path / path.name)
+    monkeypatch.setitem(rss.config,
+                        "ckanext.dcor_schemas.json_resource_schema_dir",
+                        str(tmp_path))
+    monkeypatch.setitem(
+        rss.config,
+        "ckanext.dcor_schemas.json_resource_schema_reload_interval",
+        "1")
+    index = rss.get_supplement_index()
+    assert "sp:cells:organism" in index.composite_key_set
+    assert rss.get_supplement_index() is index
+
+    # add an item to the schema
+    path = tmp_path / "supplement2_cells.json"
+    schema = json.loads(path.read_text())
+    schema["items"].append({"key": "peter pan",
+                            "name": "Peter Pan",
+                            "type": "string"})
+    path.write_text(json.dumps(schema))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    # not checked within the reload interval
+    assert rss.get_supplement_index() is index
+    monkeypatch.setattr(rss, "_index_state",
+                        rss._index_state._replace(time_checked=0))
+    index_new = rss.get_supplement_index()
+    assert index_new is not index
+    assert "sp:cells:peter pan" in index_new.composite_key_set
+    si = rss.SupplementItem.from_composite(composite_key="sp:cells:peter pan",
+                                           composite_value="Wendy")
+    assert si.value == "Wendy"
+
+    # invalid files do not replace the current index
+    path.write_text("{invalid")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+    monkeypatch.setattr(rss, "_index_state",
+                        rss._index_state._replace(time_checked=0))
+    assert rss.get_supplement_index() is index_new
+
+
 def test_supplement_item():
     si = rss.SupplementItem.from_composite(composite_key="sp:cells:organism",
                                            composite_value="human")
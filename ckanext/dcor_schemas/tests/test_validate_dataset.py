@@ -549,3 +549,44 @@ def test_dataset_state_from_draft_to_active_without_rtdc_forbidden_control():
     helpers.call_action("package_patch", test_context,
                         id=ds_dict["id"],
                         state="active")
+
+
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_dataset_state_from_draft_to_active_uses_stored_sanity_verdict():
+    """the sanity-check verdict stored for the current ETag is used"""
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    # Note: `call_action` bypasses authorization!
+    create_context = {'ignore_auth': False,
+                      'user': user['name'], 'api_version': 3}
+    test_context = {'ignore_auth': False,
+                    'user': user['name'], 'model': model, 'api_version': 3}
+    ds_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        activate=False)
+    rid = make_resource_via_s3(
+        resource_path=(data_path / "calibration_beads_47.rtdc"),
+        organization_id=owner_org['id'],
+        dataset_id=ds_dict['id'],
+    )
+    # Pretend that the background job found the data to be insane.
+    etag = "108d47e80f3e5f35110493b1fdcd30d5"
+    helpers.call_action(
+        "package_revise",
+        {'ignore_auth': True, 'user': 'default'},
+        match={"id": ds_dict["id"]},
+        **{f"update__resources__{rid}": {"etag": etag,
+                                         "dc_sanity_passed": False,
+                                         "dc_sanity_etag": etag}})
+    # assert: the data are not opened, the stored verdict is used
+    with pytest.raises(
+            logic.ValidationError,
+            match="make sure that it contains a valid DC resource"):
+        helpers.call_action("package_patch", test_context,
+                            id=ds_dict["id"],
+                            state="active")
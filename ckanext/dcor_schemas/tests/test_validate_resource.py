@@ -12,6 +12,8 @@ import ckan.tests.helpers as helpers
 
 from dcor_shared.testing import make_dataset_via_s3, synchronous_enqueue_job
 
+from ckanext.dcor_schemas import validate as dcor_validate
+
 import h5py
 import numpy as np
 
@@ -70,6 +72,29 @@ def test_resource_create_configuration_metadata_invalid():
                                 )
 
 
+def test_resource_dc_config_batch():
+    data = {
+        ("resources", 0, "id"): "foo",
+        ("resources", 0, "dc:experiment:event count"): "47",
+        ("resources", 0, "dc:experiment:time"): "10:04:03",
+        ("resources", 0, "dc:setup:flow rate"): None,
+        ("resources", 1, "dc:experiment:event count"): "invalid",
+    }
+    errors = {}
+    dcor_validate.resource_dc_config_batch(
+        ("resources", 0, "__before"), data, errors, {})
+    assert data[("resources", 0, "dc:experiment:event count")] == 47
+    assert data[("resources", 0, "dc:experiment:time")] == "10:04:03"
+    assert data[("resources", 0, "dc:setup:flow rate")] is None
+    # other resources are not touched
+    assert data[("resources", 1, "dc:experiment:event count")] == "invalid"
+    assert not errors
+
+    dcor_validate.resource_dc_config_batch(
+        ("resources", 1, "__before"), data, errors, {})
+    assert errors[("resources", 1, "dc:experiment:event count")]
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
 def test_resource_create_configuration_supplement():
@@ -278,6 +303,36 @@ def test_resource_create_same_name_forbidden():
                                 )
 
 
+@pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_resource_create_same_name_in_payload_forbidden():
+    """do not allow adding two resources with the same name at once"""
+    user = factories.User()
+    owner_org = factories.Organization(users=[{
+        'name': user['id'],
+        'capacity': 'admin'
+    }])
+    create_context = {'ignore_auth': False,
+                      'user': user['name'],
+                      'api_version': 3}
+    ds_dict = make_dataset_via_s3(
+        create_context=create_context,
+        owner_org=owner_org,
+        activate=False)
+    test_context = {'ignore_auth': False,
+                    'user': user['name'],
+                    'api_version': 3}
+    with pytest.raises(logic.ValidationError,
+                       match="is used more than once"):
+        helpers.call_action(
+            "package_revise", test_context,
+            **{"update": {
+                "id": ds_dict["id"],
+                "resources": [{"name": "data.rtdc", "url": "upload"},
+                              {"name": "data.rtdc", "url": "upload"}]}
+               })
+
+
 @pytest.mark.ckan_config('ckan.plugins', 'dcor_schemas')
 @pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
 def test_resource_create_weird_characters():
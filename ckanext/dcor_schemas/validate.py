@@ -1,9 +1,9 @@
+import functools
 import re
 import uuid
 
 import ckan.authz as authz
 import ckan.lib.navl.dictization_functions as df
-import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
@@ -11,6 +11,7 @@ import dclab
 from dcor_shared import DC_MIME_TYPES, get_dc_instance
 from slugify import slugify
 
+from . import helpers as dcor_helpers
 from . import resource_schema_supplements as rss
 
 
@@ -44,6 +45,13 @@ RESOURCE_EXTS = [
     ".so2",
 ]
 
+#: Converter functions for the "dc:sec:key" resource metadata
+DC_CONFIG_FUNCS = {
+    "dc:{}:{}".format(sec, key): dclab.dfn.get_config_value_func(sec, key)
+    for sec in dclab.dfn.CFG_METADATA
+    for key in dclab.dfn.config_keys[sec]
+}
+
 UUID_REGEXP = re.compile(
     "^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
 
@@ -217,15 +225,8 @@ def dataset_state(key, data, errors, context):
                 else:
                     is_dc = False
                 if is_dc:
-                    try:
-                        ds = get_dc_instance(res["id"])
-                        with ds, dclab.IntegrityChecker(ds) as ic:
-                            insane = ic.sanity_check()
-                            if not insane:
-                                break
-                    except (ValueError, OSError):
-                        # Unknown file format
-                        pass
+                    if resource_dc_sanity_passed(res):
+                        break
             else:
                 raise toolkit.Invalid(
                     "Before activating a dataset, make sure that it "
@@ -235,8 +236,10 @@ def dataset_state(key, data, errors, context):
 def resource_dc_config(key, data, errors, context):
     """Parse configuration parameters"""
     value = data[key]
-    _, sec, skey = key[-1].split(":")
-    func = dclab.dfn.get_config_value_func(sec, skey)
+    func = DC_CONFIG_FUNCS.get(key[-1])
+    if func is None:
+        _, sec, skey = key[-1].split(":")
+        func = dclab.dfn.get_config_value_func(sec, skey)
     try:
         value = func(value)
     except BaseException:
@@ -245,6 +248,79 @@ def resource_dc_config(key, data, errors, context):
     data[key] = value
 
 
+def resource_dc_config_batch(key, data, errors, context):
+    """Parse all configuration parameters of a resource
+
+    This is a "__before" validator of the resource schema that converts
+    all "dc:sec:key" values of one resource in one pass. Values that are
+    identical to the values stored for the resource are not converted
+    again.
+    """
+    prefix = key[:-1]
+    stored = get_current_resources(data, context).get(
+        data.get(prefix + ("id",)), {})
+    for data_key in list(data):
+        if (len(data_key) != 3
+                or data_key[:2] != prefix
+                or data_key[2] not in DC_CONFIG_FUNCS):
+            continue
+        value = data[data_key]
+        if value is df.missing or value is None:
+            continue
+        dc_key = data_key[2]
+        if dc_key in stored and stored[dc_key] == value:
+            # unchanged (already converted)
+            continue
+        try:
+            data[data_key] = DC_CONFIG_FUNCS[dc_key](value)
+        except BaseException:
+            errors.setdefault(data_key, []).append(
+                "Invalid value for '{}': '{}'!".format(dc_key, value))
+
+
+def resource_dc_sanity_passed(res_dict):
+    """Return whether a DC resource passes the dclab sanity check
+
+    The sanity check is performed in the background job
+    `job_set_dc_metadata` and its verdict is stored in the resource
+    metadata together with the ETag of the inspected S3 object. Only
+    if there is no verdict for the current ETag, the resource is opened
+    and checked here. Those live checks are cached for each resource
+    ID and ETag, so repeated activation attempts do not open the same
+    data again.
+    """
+    etag = res_dict.get("etag")
+    sane = res_dict.get("dc_sanity_passed")
+    if sane is not None and res_dict.get("dc_sanity_etag") == etag:
+        return toolkit.asbool(sane)
+
+    try:
+        if etag:
+            return resource_dc_sanity_check_etag(res_dict["id"], etag)
+        else:
+            return resource_dc_sanity_check(res_dict["id"])
+    except (ValueError, OSError):
+        # Unknown file format
+        return False
+
+
+def resource_dc_sanity_check(resource_id):
+    """Open a DC resource and run the dclab sanity check"""
+    ds = get_dc_instance(resource_id)
+    with ds, dclab.IntegrityChecker(ds) as ic:
+        insane = ic.sanity_check()
+    return not insane
+
+
+@functools.lru_cache(maxsize=1000)
+def resource_dc_sanity_check_etag(resource_id, etag):
+    """Cached `resource_dc_sanity_check` for a given S3 object ETag
+
+    The `etag` argument is only used as part of the cache key.
+    """
+    return resource_dc_sanity_check(resource_id)
+
+
 def resource_dc_supplement(key, data, errors, context):
     """Parse user-defined supplementary parameters"""
     value = data[key]
@@ -304,22 +380,70 @@ def resource_name(key, data, errors, context):
             u"".join(invalid_chars)))
 
     # do not allow adding resources that exist already
-    package = context.get('package')
-    if package:
-        package_id = package.id
-    else:
-        package_id = data.get(key[:-1] + ('id',))
-    pkg_dict = logic.get_action('package_show')(
-        dict(context, return_type='dict'),
-        {'id': package_id})
-
-    ress = pkg_dict.get("resources", [])
-    if ress:
-        # check name
-        for item in ress:
-            # Since this function is called for each and every
-            # resource all the time, we have to make sure that
-            # the positions are not matching.
-            if key[1] != item["position"] and item["name"] == name:
-                raise toolkit.Invalid(
-                    "Resource with name '{}' already exists!".format(name))
+    existing, incoming = get_resource_name_positions(key, data, context)
+    # Since this function is called for each and every resource all the
+    # time, we have to make sure that the positions are not matching.
+    if existing.get(name, set()) - {key[1]}:
+        raise toolkit.Invalid(
+            "Resource with name '{}' already exists!".format(name))
+    if incoming.get(name, set()) - {key[1]}:
+        raise toolkit.Invalid(
+            "Resource name '{}' is used more than once!".format(name))
+
+
+def get_resource_name_positions(key, data, context):
+    """Return the positions of the resource names in a dataset
+
+    The positions are computed only once per validation pass (the
+    result is stored in the validation context) and not for every
+    resource that is validated.
+
+    Returns
+    -------
+    existing: dict
+        maps the resource names of the current dataset to their positions
+    incoming: dict
+        maps the resource names in `data` (the data that is validated)
+        to their positions
+    """
+    cached = context.get("dcor_schemas_resource_name_positions")
+    if cached is None or cached[0] is not data:
+        package = context.get('package')
+        if package:
+            package_id = package.id
+        else:
+            package_id = data.get(key[:-1] + ('id',))
+        pkg_dict = dcor_helpers.get_package_dict(context, package_id)
+        existing = {}
+        for item in pkg_dict.get("resources", []):
+            existing.setdefault(item["name"], set()).add(item["position"])
+        incoming = {}
+        for data_key, value in data.items():
+            if (len(data_key) == 3
+                    and data_key[0] == "resources"
+                    and data_key[2] == "name"
+                    and isinstance(value, str)):
+                incoming.setdefault(value, set()).add(data_key[1])
+        cached = (data, existing, incoming)
+        context["dcor_schemas_resource_name_positions"] = cached
+    return cached[1], cached[2]
+
+
+def get_current_resources(data, context):
+    """Return the stored resources of the validated dataset
+
+    Returns a dictionary mapping resource IDs to the resource dictionaries
+    of the dataset in `context` (empty when a dataset is created). The
+    dictionary is computed only once per validation pass.
+    """
+    cached = context.get("dcor_schemas_current_resources")
+    if cached is None or cached[0] is not data:
+        package = context.get('package')
+        resources = {}
+        if package:
+            pkg_dict = dcor_helpers.get_package_dict(context, package.id)
+            for res in pkg_dict.get("resources", []):
+                resources[res["id"]] = res
+        cached = (data, resources)
+        context["dcor_schemas_current_resources"] = cached
+    return cached[1]